@@ -6,6 +6,22 @@ __project__ = "atmark"
 __author__ = "Kirill Klenov <horneds@gmail.com>"
 __license__ = "BSD"
 
-from .atmark import _at, _atat, _cli
+import sys
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        """ Import the commands on first use: the client (`atmark.client`)
+        starts without them.
+
+        """
+        if name in ('_at', '_atat', '_cli'):
+            from . import atmark
+
+            return getattr(atmark, name)
+        raise AttributeError(name)
+
+else:
+    from .atmark import _at, _atat, _cli
 
 # pylama:ignore=W0611
@@ -1,5 +1,6 @@
 import os
-from .commands import AT_COMMANDS
+
+from . import __version__
 from .utils import echo
 
 
@@ -15,6 +16,42 @@ complete -F _atmark_complete -o default @ @@;
 """
 
 
+def _index_path():
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    commands = os.path.join(os.path.dirname(__file__), 'commands.py')
+    return os.path.join(cache, 'atmark', 'commands-%s-%d' % (
+        __version__, os.path.getmtime(commands)))
+
+
+def completion_index():
+    """ Get names of the commands with numbers of their params.
+
+    The index is cached on the first use, so completion doesn't import the
+    commands.
+
+    """
+    path = _index_path()
+    try:
+        with open(path) as f:
+            return dict((name, int(nump)) for name, nump in (
+                line.rsplit(' ', 1) for line in f.read().splitlines()))
+    except (IOError, OSError, ValueError):
+        pass
+
+    from .commands import AT_COMMANDS
+
+    index = dict((name, nump) for name, (_, nump) in AT_COMMANDS.items())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as f:
+            f.write("".join("%s %d\n" % item for item in sorted(index.items())))
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        pass
+    return index
+
+
 def do_complete():
     cwords = os.environ['COMP_WORDS'].split()
     cword = int(os.environ['COMP_CWORD'])
@@ -29,12 +66,11 @@ def do_complete():
     except IndexError:
         pass
 
-    if previous in AT_COMMANDS:
-        _, nump = AT_COMMANDS.get(previous)
-        if nump:
-            return False
+    index = completion_index()
+    if index.get(previous):
+        return False
 
-    for item in AT_COMMANDS.keys():
+    for item in sorted(index):
         if item.startswith(incomplete):
             echo(item)
 
@@ -13,100 +13,391 @@ It is mean:
 
     $ ls > replace($LINE, "_", "-") > split($RESULT, ".") > format($RESULT, "mv $LINE $RESULT.jpg")
 
-You can use `--debug` argument (@ --debug ARGS) for debug Armark commands. """
+You can use `--debug` argument (@ --debug ARGS) for debug Armark commands.
+
+Options:
+
+    --approx ERROR          count `@@ topk` and `@@ distinct` with bounded memory
+                            and the given relative error (0.01)
+    --batch N               process lists of N lines at once when the commands
+                            support it (filters, format and string commands)
+    --block-size SIZE       read the input by blocks of SIZE (1M)
+    --checkpoint FILE       with --follow, save the offset of the processed lines
+                            to the FILE and start from it next time
+    --concurrent-files N    with --file, read and decompress N files at once (1)
+    --csv                   read CSV records (quoted fields may have line breaks),
+                            `col N` and `get NAME` (by the header) get the fields
+    -d, --debug             print the plan (see --explain) and the history
+                            of every result (of the commands as typed)
+    --dry-run               with --exec, print the commands instead of running
+    --exec                  run every result as a shell command (as `| sh`)
+    --explain               print the commands as they are run (after the
+                            optimizer's rewrites) without reading the input
+    -f FILE, --file FILE    read the FILE instead of stdin, the option can be
+                            repeated; gzip, bz2, xz and zstd files (and stdin)
+                            are decompressed in a background thread
+    --follow FILE           read the FILE and wait for the appended lines (as
+                            `tail -F`), rotated and truncated files are reopened;
+                            SIGTERM and ^C stop it, --out-by files are appended
+    -j N, --jobs N          process lines in N worker processes
+    --json                  read JSON lines, `get KEY.PATH` and `col N` (of arrays)
+                            get the fields; records are parsed once, on first use
+    --line-buffered         flush output after every line (default for terminals);
+                            otherwise it's flushed by 64K or by the next result after 1s
+    -m N, --max-count N     stop after N results, the rest of the input is not read
+    --max-open N            with --out-by, number of the files open at once (128)
+    --mem SIZE              memory budget of `@@ sort` (512M, 2G); sorted runs
+                            over the budget are merged from temporary files
+    --memo SIZE             cache results of SIZE distinct lines (for repeated
+                            lines, when all the commands are pure)
+    -n N                    with --exec, run N results by a single shell
+    --no-compile            run the commands one by one without compiling them
+    --out-by TEMPLATE       write results to the files by the path TEMPLATE
+                            ("logs/#1.log", see `format`) instead of stdout
+    -P N                    with --exec, run N shells at once (1)
+    --profile, --stats      print calls, passed/dropped values, time and bytes
+                            of every command to stderr at exit
+    --queue-size N          number of the blocks read ahead of processing (8)
+    --regexp ENGINE         compile regexps with ENGINE: re, regex or re2
+                            (also $ATMARK_REGEXP)
+    --server                serve `@` and `@@` from a warm process on a Unix socket
+                            ($ATMARK_SOCKET), they use it while it's running
+    --stats-file PATH       save the stats for the Prometheus textfile collector
+    --stats-json            print the stats to stderr as JSON
+    --unique MODE           how `unique` remembers the keys: exact, hash (packed
+                            64-bit digests, 12-24 bytes a key) or bloom[:RATE]
+                            (false positives at RATE, 0.001)
+    --unordered             with --jobs or --exec, print results (output of the
+                            commands) as soon as they are ready
+    -bs, --bash-source      print bash completion script
+    -h, --help              show this message """
 import os
+import signal
 import sys
+from itertools import islice
 
 from ._bashcomplete import do_complete, COMPLETION_SCRIPT
-from .commands import AT_COMMANDS, at_format, AT_COMMANDS_DOCS
-from .utils import echo, style, get_stream, ANSI, text_type, unicode_escape
+from .client import at, atat # noqa, the entry points
+from .output import Output, OutputError, watch
+from .pipeline import (
+    Arg, Memo, compile_batch, describe, history_refs, is_pure, optimize, processor)
+from .streams import is_stream, set_approx, set_memory, set_unique
+from .utils import (
+    echo, style, get_stream, parse_size, set_regexp_engine, ANSI, text_type,
+    unicode_escape, BLOCK_SIZE)
 
 
-class Arg(object):
+def _at(args, stream, max_count=None, **options):
+    results = _pipeline(args, stream, **options)
+    return _limit(results, max_count) if max_count else results
 
-    """ Store changes history. """
 
-    def __init__(self, value=""):
-        self.start = value
-        self.value = value
-        self.history = [value]
+def _limit(results, count):
+    """ Stop after `count` results without reading the input any further. """
+    results = iter(results)
+    try:
+        for result in islice(results, count):
+            yield result
+    finally:
+        getattr(results, 'close', lambda: None)()
+
+
+def _pipeline(args, stream, no_compile=False, debug=False, jobs=1, unordered=False,
+        stats=None, batch=None, out_by=None, memo=None, tokens=None, **options):
+    tokens = list(_tokenize(args)) if tokens is None else tokens
+    keep = None if debug else history_refs(tokens)
+
+    # The history states used by the path of the output are kept with results
+    refs = out_by.numbers if out_by else ()
+    if keep is not None:
+        keep.update(refs)
 
-    def __repr__(self):
-        return " > ".join(text_type(h) for h in self.history)
+    tokens = optimize(tokens, keep)
 
-    def __str__(self):
-        if isinstance(self.value, list):
-            return "".join(self.value)
-        return text_type(self.value)
+    if stats:
+        tokens = stats.instrument(tokens)
+        stream = stats.count(stream)
 
-    __unicode__ = __str__
+    # The stats are counted in this process only, commands with a state see
+    # all the lines in it
+    elif jobs > 1 and not debug and not refs and is_pure(tokens):
+        from . import parallel
 
-    def process(self, tokens):
-        for func, params in tokens:
-            self.update(func(self, *params))
-            if self.value is None:
-                break
-        return self
+        for result in parallel.process(
+                tokens, stream, jobs, keep, not no_compile, unordered, memo=memo):
+            yield result
+        return
 
-    def update(self, value):
-        self.value = value
-        self.history.append(value)
+    # Process lists of lines when the commands support it and the history is unused
+    process = None
+    if batch and keep is not None and not keep and not no_compile:
+        process = compile_batch(tokens)
 
+    if process:
+        from .parallel import chunks
+
+        for lines in chunks(stream, batch):
+            for value in process(lines):
+                yield value
+        return
+
+    process = processor(tokens, keep, not no_compile, not debug and memo)
+    if stats and isinstance(process, Memo):
+        stats.memo = process
 
-def _at(args, stream):
-    tokens = list(_tokenize(args))
     for line in stream:
-        arg = Arg(line).process(tokens)
+        arg = process(line)
         if arg.value is not None:
             yield arg
 
 
-def _atat(args, stream):
-    tokens = list(_tokenize(args))
-    arg = Arg(list(stream)).process(tokens)
-    if not isinstance(arg.value, list):
-        return [arg.value]
-    return arg.value
-
-
-def _cli(func, args):
+def _plan(args, optimized=True, out_by=None, tokens=None, **options):
+    """ Describe the commands as they are run and the rewrites of the optimizer. """
+    tokens = list(_tokenize(list(args))) if tokens is None else tokens
+    notes = []
+    if optimized:
+        keep = history_refs(tokens)
+        keep.update(out_by.numbers if out_by else ())
+        tokens = optimize(tokens, keep, notes)
+    return ["plan: " + " | ".join(describe(*token) for token in tokens)] + [
+        "  " + note for note in notes]
+
+
+def _atat(args, stream, debug=False, stats=None, tokens=None, max_count=None, **options):
+    tokens = list(_tokenize(args)) if tokens is None else tokens
+
+    # Keep the stream lazy while commands support it and the history is unused
+    keep = None if debug else history_refs(tokens)
+    if stats:
+        tokens = stats.instrument(tokens)
+        stream = stats.count(stream)
+    if keep is None or keep:
+        stream = list(stream)
+
+    arg = Arg(stream, keep)
+    for func, params in tokens:
+        if is_stream(arg.value):
+            if func.stream:
+                arg.update(func.stream(arg.value, *params))
+                if arg.value is None:
+                    break
+                continue
+            arg.value = list(arg.value)
+        arg.update(func(arg, *params))
+        if arg.value is None:
+            break
+
+    results = arg.value
+    if not is_stream(results) and not isinstance(results, list):
+        results = [results]
+    return _limit(results, max_count) if max_count else results
+
+
+def _template(string):
+    from .template import Template
+
+    return Template(unicode_escape(string))
+
+
+OPTIONS = {
+    '--approx': ('approx', set_approx),
+    '-bs': ('bash_source', None),
+    '--bash-source': ('bash_source', None),
+    '--batch': ('batch', int),
+    '--block-size': ('block_size', parse_size),
+    '--checkpoint': ('checkpoint', str),
+    '--concurrent-files': ('concurrent_files', int),
+    '--csv': ('csv', None),
+    '-d': ('debug', None),
+    '--dry-run': ('dry_run', None),
+    '--debug': ('debug', None),
+    '--exec': ('exec_', None),
+    '--explain': ('explain', None),
+    '-f': ('files', list),
+    '--file': ('files', list),
+    '--follow': ('follow', str),
+    '-h': ('help', None),
+    '--help': ('help', None),
+    '--json': ('json', None),
+    '-j': ('jobs', int),
+    '--jobs': ('jobs', int),
+    '--line-buffered': ('line_buffered', None),
+    '-m': ('max_count', int),
+    '--max-count': ('max_count', int),
+    '--max-open': ('max_open', int),
+    '--mem': ('mem', set_memory),
+    '--memo': ('memo', int),
+    '-n': ('exec_size', int),
+    '--no-compile': ('no_compile', None),
+    '--out-by': ('out_by', _template),
+    '-P': ('exec_jobs', int),
+    '--profile': ('stats', None),
+    '--queue-size': ('queue_size', int),
+    '--regexp': ('regexp', set_regexp_engine),
+    '--server': ('server', None),
+    '--stats': ('stats', None),
+    '--stats-file': ('stats_file', str),
+    '--stats-json': ('stats_json', None),
+    '--unique': ('unique', set_unique),
+    '--unordered': ('unordered', None),
+}
+
+
+def _options(args):
+    """ Pop the leading options from args, exit with a message on invalid ones. """
+    options = dict()
+    while args and args[0] in OPTIONS:
+        option = args.pop(0)
+        name, type_ = OPTIONS[option]
+        if not type_:
+            options[name] = True
+            continue
+        if not args:
+            sys.exit("atmark: %s needs a value" % option)
+        value = args.pop(0)
+        if type_ is list:
+            options.setdefault(name, []).append(value)
+            continue
+        try:
+            options[name] = type_(value)
+        except (ImportError, ValueError) as exc:
+            sys.exit("atmark: %s %s: %s" % (option, value, exc))
+    return options
+
+
+def _input(files=None, block_size=BLOCK_SIZE, queue_size=None, concurrent_files=1,
+           json=None, csv=None, follow=None, checkpoint=None, flush=None, **options):
+    """ Get lines of the given files, the followed file or stdin (records of
+    JSON or CSV).
+
+    """
+    if follow:
+        from .follow import follow as follow_file
+
+        stream = follow_file(follow, checkpoint, flush, block_size=block_size)
+
+    elif not files:
+        stream = get_stream(sys.stdin, block_size=block_size)
+    else:
+        from .inputs import read_files, QUEUE_SIZE
+
+        stream = read_files(files, block_size=block_size,
+                            queue_size=queue_size or QUEUE_SIZE, concurrent=concurrent_files)
+
+    if json or csv:
+        from . import records
+
+        records.set_mode('csv' if csv else 'json')
+        if csv:
+            stream = records.csv_records(stream)
+    return stream
+
+
+def _output(out_by=None, max_open=None, line_buffered=None, exec_=None, dry_run=None,
+            exec_jobs=1, exec_size=1, unordered=False, follow=None, **options):
+    """ Get the output to stdout, to the files by the template or to the shell. """
+    if exec_ and not dry_run:
+        from .execute import Executor
+
+        watch()
+        return Executor(exec_jobs, exec_size, not unordered)
+
+    if out_by:
+        from .output import PartitionedOutput, MAX_OPEN
+
+        return PartitionedOutput(out_by, max_open or MAX_OPEN, append=bool(follow))
+    watch()
+    return Output(line_buffered=line_buffered)
+
+
+def _cli(func, args, tokens=None):
     if os.environ.get('_ATMARK_COMPLETE'):
         return do_complete()
 
-    if args:
-        if args[0] in ('-h', '--help'):
-            echo(style(__doc__, bold=True, fg='green'))
-            echo(AT_COMMANDS_DOCS)
-            sys.exit()
+    options = _options(args)
+    if tokens is not None:
+        options['tokens'] = tokens
+
+    if options.get('server'):
+        from .server import serve
+
+        return serve()
+
+    if options.get('help'):
+        echo(style(__doc__, bold=True, fg='green'))
+        from .commands import commands_docs
+
+        echo(commands_docs())
+        sys.exit()
 
-        elif args[0] in ('-d', '--debug'):
-            args.pop(0)
-
-            def gen():
-                while True:
-                    for c in ANSI.colors[1:7]:
-                        yield c
-            gen = gen()
-
-            stream = get_stream()
-            for arg in func(args, stream):
-                color = next(gen)
-                echo("\n".join(
-                    style("#%d" % num + " " + text_type(state), fg=color)
-                    for num, state in enumerate(arg.history)))
+    if options.get('bash_source'):
+        return echo(COMPLETION_SCRIPT)
+
+    if options.get('explain') or options.get('debug'):
+        echo(style("\n".join(_plan(args, func is _at, **options)), bold=True))
+        if not options.get('debug'):
             sys.exit()
 
-        elif args[0] in ('-bs', '--bash-source'):
-            return echo(COMPLETION_SCRIPT)
+    if options.get('debug'):
+
+        def gen():
+            while True:
+                for c in ANSI.colors[1:7]:
+                    yield c
+        gen = gen()
+
+        stream = _input(**options)
+        for arg in func(args, stream, **options):
+            color = next(gen)
+            echo("\n".join(
+                style("#%d" % num + " " + text_type(state), fg=color)
+                for num, state in sorted(arg.history.items())))
+        sys.exit()
+
+    stats = table = options.get('stats')
+    if stats or options.get('stats_json') or options.get('stats_file'):
+        from .stats import Stats
 
-    stream = get_stream()
-    for arg in func(args, stream):
-        echo(arg)
+        stats = options['stats'] = Stats()
 
-    sys.exit()
+    if options.get('follow'):
+        # Every line is processed at once and the results are written before
+        # the checkpoint is saved
+        options.update(jobs=1, batch=None)
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(128 + signal.SIGTERM))
+
+    output = _output(**options)
+    stream = _input(flush=getattr(output, 'flush', None), **options)
+    try:
+        try:
+            for arg in func(args, stream, **options):
+                output.write(arg)
+        finally:
+            # The followed file writes the results and saves the checkpoint
+            getattr(stream, 'close', lambda: None)()
+
+    # A signal is the end of the followed file, the written results are kept
+    except (KeyboardInterrupt, SystemExit):
+        output.close(bool(options.get('follow')))
+        raise
+    except BaseException as exc:
+        output.close(False)
+        if isinstance(exc, OutputError):
+            sys.exit("atmark: %s" % exc)
+        raise
+    try:
+        output.close()
+    except OutputError as exc:
+        sys.exit("atmark: %s" % exc)
+
+    if stats:
+        stats.write(table, options.get('stats_json'), options.get('stats_file'))
+
+    sys.exit(getattr(output, 'status', 0))
 
 
 def _tokenize(args):
+    from .commands import AT_COMMANDS, at_format
 
     def take_params(args, nump):
         """ Function description. """
@@ -114,6 +405,12 @@ def _tokenize(args):
             nump -= 1
             yield unicode_escape(args.pop(0))
 
+    def prepare(func, params):
+        """ Prepare the params once (compile regexps and etc). """
+        if func.prepare:
+            return list(func.prepare(*params))
+        return params
+
     try:
         while args:
             arg = args.pop(0).strip()
@@ -122,19 +419,13 @@ def _tokenize(args):
                 params = list(take_params(args, nump)) if nump else []
                 if arg == 'map':
                     f, nump = AT_COMMANDS[params[0]]
-                    params = [f] + list(take_params(args, nump))
-                yield func, params
+                    params = [f] + prepare(f, list(take_params(args, nump)))
+                yield func, prepare(func, params)
                 continue
-            yield at_format, [unicode_escape(arg)]
+            yield at_format, prepare(at_format, [unicode_escape(arg)])
     except IndexError:
-        yield at_format, ['@']
-
-
-at = lambda: _cli(_at, sys.argv[1:])
-atat = lambda: _cli(_atat, sys.argv[1:])
+        yield at_format, prepare(at_format, ['@'])
 
 
 if __name__ == '__main__':
     at()
-
-# pylama:ignore=E731
@@ -0,0 +1,188 @@
+""" Forward `@` to a running server (`@ --server`).
+
+The module is the entry point of `@` and `@@`. It imports nothing from the
+package (but the commands when they run in the process), so the client
+starts fast.
+
+Frames are a type byte, a length and the data. The client sends the
+request ('a') and stdin ('i', an empty frame at the end); the server sends
+stdout ('o'), stderr ('e') and the exit status ('x').
+
+"""
+import os
+import stat
+import struct
+import sys
+
+
+HEADER = struct.Struct('!cI')
+BLOCK_SIZE = 1 << 16
+PY2 = sys.version_info[0] == 2
+
+
+def socket_path():
+    """ Get a path of the server's socket ($ATMARK_SOCKET). None when the
+    platform has no Unix sockets.
+
+    """
+    if not hasattr(os, 'getuid'):
+        return None
+    path = os.environ.get('ATMARK_SOCKET')
+    if path:
+        return path
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'atmark.sock')
+    return '/tmp/atmark-%d/atmark.sock' % os.getuid()
+
+
+def is_private(path):
+    """ Check the path belongs to the user and is closed to the others. """
+    try:
+        info = os.lstat(path)
+    except EnvironmentError:
+        return False
+    return info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+
+def is_trusted(path):
+    """ Check the socket and its directory are private, so nobody else could
+    put there a socket which gets the arguments, environment and input of `@`.
+
+    """
+    return (is_private(os.path.dirname(os.path.abspath(path))) and is_private(path) and
+            stat.S_ISSOCK(os.lstat(path).st_mode))
+
+
+def send(sock, kind, data=b''):
+    sock.sendall(HEADER.pack(kind, len(data)) + data)
+
+
+def _read(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def receive(sock):
+    """ Get the next frame as (type, data). """
+    kind, size = HEADER.unpack(_read(sock, HEADER.size))
+    return kind, _read(sock, size) if size else b''
+
+
+def encode(values):
+    # Arguments and environment of Python 2 are bytes already
+    data = '\0'.join(values)
+    return data if PY2 else data.encode('utf-8', 'surrogateescape')
+
+
+def decode(data):
+    return (data if PY2 else data.decode('utf-8', 'surrogateescape')).split('\0')
+
+
+def _isatty(stream):
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+def _pump(sock, stream):
+    """ Send the stream to the server in frames. """
+    try:
+        if not _isatty(stream):
+            while True:
+                data = os.read(stream.fileno(), BLOCK_SIZE)
+                if not data:
+                    break
+                send(sock, b'i', data)
+        send(sock, b'i')
+    except (EnvironmentError, ValueError):
+        pass
+
+
+def forward(name, args):
+    """ Run `@` (or `@@`) by the server. Return the exit status or None when
+    there is no running server.
+
+    """
+    path = socket_path()
+    if path is None or not is_trusted(path):
+        return None
+
+    # The C modules: `socket` and `threading` import `enum`, `selectors`...
+    try:
+        import _socket as socket
+        from _thread import start_new_thread
+    except ImportError:
+        import socket
+        from thread import start_new_thread
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    environ = ['%s=%s' % item for item in os.environ.items()]
+    send(sock, b'a', encode(
+        [name, os.getcwd(), _isatty(sys.stdout) and '1' or '', str(len(args))] +
+        list(args) + environ))
+
+    start_new_thread(_pump, (sock, sys.stdin))
+
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    stderr = getattr(sys.stderr, 'buffer', sys.stderr)
+    try:
+        while True:
+            kind, data = receive(sock)
+            if kind == b'o':
+                stdout.write(data)
+                stdout.flush()
+            elif kind == b'e':
+                stderr.write(data)
+                stderr.flush()
+            elif kind == b'x':
+                return int(data)
+    except EOFError:
+        return 1
+    finally:
+        sock.close()
+
+
+def main(name):
+    """ Run `@` (or `@@`) by the server when it's running (see `--server`),
+    otherwise in this process.
+
+    SIGPIPE is restored to its default action, so when the reader of the
+    output is gone (`@ ... | head -1`) the process exits quietly as `grep`
+    does, instead of reading the rest of the input. (Windows has no SIGPIPE.)
+
+    """
+    try:
+        import _signal as signal # `signal` of Python 3 imports `enum`
+    except ImportError:
+        import signal
+
+    if hasattr(signal, 'SIGPIPE'):
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    args = sys.argv[1:]
+    if '--server' not in args and not os.environ.get('_ATMARK_COMPLETE'):
+        status = forward(name, args)
+        if status is not None:
+            sys.exit(status)
+
+    from .atmark import _at, _atat, _cli
+
+    _cli(_atat if name == 'atat' else _at, args)
+
+
+at = lambda: main('at')
+atat = lambda: main('atat')
+
+# pylama:ignore=E731
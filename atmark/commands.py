@@ -1,78 +1,150 @@
-import re
+from . import records, streams
+from .template import Template
+from .utils import style, text_type, regexp as compile_regexp, ANSI
 
-from functools import wraps
 
-from .utils import style, text_type, ANSI
+AT_COMMANDS = dict()
+AT_COMMANDS_NAMES = []
 
 
-AT_COMMANDS = dict()
-AT_COMMANDS_DOCS = style("""
-===================================================================================
-LIST OF THE BUILT IN FUNCTIONS
-""", fg='yellow')
-CURRENT_RE = re.compile(r'(?=[^\\]?)@')
-HISTORY_RE = re.compile(r'(?=[^\\]?)#(\d)*')
+def _command(nump=0, *syns, **meta):
+    """ Save function as At command.
 
+    Meta options are stored as the function's attributes:
 
-def _command(nump=0, *syns):
-    """ Save function as At command. """
+        returns -- type of the result: 'str', 'list' (of strings), 'same' (as the
+                   given value) or 'item' (an element of the given value)
+        inline  -- the command as a python expression for string values,
+                   where {0} is the value and {1}, {2}... are the params
+        refs    -- function which returns numbers of the history states used
+                   by the command with the given params
+        prepare -- function which converts the params once when the command
+                   is parsed
+        stream  -- implementation for a lazy stream of lines (`@@`), which is
+                   called with the stream and the params
+        batch   -- the command as a python expression for a list of strings
+                   (`--batch`), where {0} is the list and {1}, {2}... are
+                   the params
+        pure    -- False when the result depends on the previous values
+                   (the command has a state), so it can't be cached (`--memo`)
+
+    """
 
     def decorator(func):
         name = func.__name__[3:]
         AT_COMMANDS[name] = func, nump
-        global AT_COMMANDS_DOCS
-        AT_COMMANDS_DOCS += "\n\n" + (func.__doc__ or "%s") % "/".join(
-            style(n, fg='yellow') for n in (name,) + syns)
+        AT_COMMANDS_NAMES.append((func, (name,) + syns))
         for syn in syns or []:
             AT_COMMANDS[syn] = func, nump
-
-        @wraps(func)
-        def wrapper(*args):
-            return func(*args)
-        return wrapper
+        func.returns = meta.get('returns')
+        func.inline = meta.get('inline')
+        func.refs = meta.get('refs')
+        func.prepare = meta.get('prepare')
+        func.stream = meta.get('stream')
+        func.batch = meta.get('batch')
+        func.pure = meta.get('pure', True)
+        return func
 
     return decorator
 
 
-@_command(1)
-def at_format(arg, string):
+def commands_docs():
+    """ Build the list of the commands for help. """
+    docs = style("""
+===================================================================================
+LIST OF THE BUILT IN FUNCTIONS
+""", fg='yellow')
+    for func, names in AT_COMMANDS_NAMES:
+        docs += "\n\n" + (func.__doc__ or "%s") % "/".join(
+            style(n, fg='yellow') for n in names)
+    return docs
+
+
+def _regexps(*patterns):
+    return [compile_regexp(pattern) for pattern in patterns]
+
+
+def _templates(*strings):
+    return [Template(string) for string in strings]
+
+
+def _field(value, sep, num):
+    """ Get the N-th field without splitting the rest of the string. """
+    try:
+        if num < 0:
+            return value.rsplit(sep, -num)[num]
+        return value.split(sep, num + 1)[num]
+    except (ValueError, IndexError):
+        return None
+
+
+def _span(spec):
+    """ Parse a range of fields: 'N', 'N-M' (inclusive), 'N-' or '-M'. """
+    start, dash, stop = spec.partition('-')
+    start = int(start or 0)
+    if not dash:
+        return start, start + 1
+    return start, int(stop) + 1 if stop else None
+
+
+def _fields(value, sep, start, stop):
+    try:
+        if stop is None:
+            return value.split(sep)[start:]
+        return value.split(sep, stop)[start:stop]
+    except ValueError:
+        return None
+
+
+@_command(1, returns='str', prepare=_templates, refs=lambda template: template.numbers,
+          batch='[{1}.render(v) for v in {0}]')
+def at_format(arg, template):
     """ %s FORMAT_STRING \t -- format and print a string.
 
     Symbol '@' in FORMAT_STRING represents the current value in process of composition of fuctions.
     Symbol '#' in FORMAT_STRING represents the history state.
         Where   # or #0 -- first state, #<n> (#1, #2) -- state with number n
+    Use '\\@' and '\\#' for the literal symbols.
 
     Synonyms: You can drop `format` function name. This lines are equalent:
 
         $ ls | @ upper format "@.BAK"
         $ ls | @ upper "@.BAK" """
-    value = text_type(arg)
-    value = CURRENT_RE.sub(value, string)
-
-    def get_history(m):
-        index = int(m.group(1) or 0)
-        try:
-            return text_type(arg.history[index])
-        except IndexError:
-            return ""
+    return template.render(arg)
 
-    return HISTORY_RE.sub(get_history, value)
 
-
-@_command(0, 'cap')
+@_command(0, 'cap', returns='str', inline='{0}[0].upper() + {0}[1:].lower()')
 def at_capitalize(arg):
     """ %s \t -- capitalize the string. """
     value = text_type(arg)
     return value[0].upper() + value[1:].lower()
 
 
-@_command(1)
+@_command(1, returns='str', prepare=lambda num: [int(num)])
+def at_col(arg, num):
+    """ %s N \t\t\t -- get the N-th column of CSV line (from 0). """
+    return records.lookup(records.record(arg, 'csv'), [num])
+
+
+@_command(0, returns='list', stream=streams.count)
+def at_count(arg):
+    """ %s \t\t -- count equal elements, return "COUNT ELEMENT" list (most common first). """
+    return streams.count(arg.value)
+
+
+@_command(0, returns='str', stream=streams.distinct)
+def at_distinct(arg):
+    """ %s \t\t -- return number of distinct elements (approximate with --approx). """
+    return streams.distinct(arg.value)
+
+
+@_command(1, returns='same', stream=streams.drop)
 def at_drop(arg, length):
     """ %s N \t\t -- drop N elements from list/string. """
     return arg.value[int(length):]
 
 
-@_command(1, '==')
+@_command(1, '==', returns='str', batch='[v for v in {0} if v == {1}]')
 def at_equal(arg, pattern):
     """ %s PATTERN \t -- return None if arg is not equal to PATTERN. """
     value = text_type(arg)
@@ -80,7 +152,33 @@ def at_equal(arg, pattern):
         return value
 
 
-@_command(0, 'if')
+@_command(2, 'f', returns='str', prepare=lambda sep, num: [sep, int(num)])
+def at_field(arg, sep, num, nonempty=False):
+    """ %s SEPARATOR N 	 -- get the N-th field of the string splited by SEPARATOR (from 0). """
+    value = _field(text_type(arg), sep, num)
+    return (value or None) if nonempty else value
+
+
+@_command(1, 'f_', returns='str', prepare=lambda num: [int(num)])
+def at_field_(arg, num):
+    """ %s N 		 -- same as field but splits the string by whitespace characters """
+    return _field(text_type(arg), None, num)
+
+
+@_command(2, returns='list', prepare=lambda sep, spec: [sep, _span(spec)])
+def at_fields(arg, sep, span):
+    """ %s SEPARATOR RANGE 	 -- get a list of the fields N-M, N- or -M (from 0, inclusive). """
+    return _fields(text_type(arg), sep, *span)
+
+
+@_command(1, returns='list', prepare=lambda spec: [_span(spec)])
+def at_fields_(arg, span):
+    """ %s RANGE 		 -- same as fields but splits the string by whitespace characters """
+    return _fields(text_type(arg), None, *span)
+
+
+@_command(0, 'if', returns='same', stream=streams.nonempty,
+          batch='[v for v in (v.strip() for v in {0}) if v]')
 def at_filter(arg):
     """ %s \t\t -- filter results by value has length """
     if isinstance(arg.value, list):
@@ -88,13 +186,26 @@ def at_filter(arg):
     return arg.value.strip() or None
 
 
-@_command(0, 'h')
+@_command(1, returns='str', prepare=lambda spec: [records.path(spec)])
+def at_get(arg, keys):
+    """ %s KEY.PATH \t -- get a field of JSON line ("user.name", "items.0.id") or
+    a column of CSV line by its name in the header (with --csv). """
+    return records.lookup(records.record(arg, 'json'), keys)
+
+
+@_command(1, returns='list', stream=streams.groupby)
+def at_groupby(arg, field):
+    """ %s N \t\t -- group lines by N-th whitespace separated field, keep the order of groups. """
+    return streams.groupby(arg.value, field)
+
+
+@_command(0, 'h', returns='item', stream=streams.head)
 def at_head(arg):
     """ %s \t\t -- extract the first element/character of a list/string """
     return arg.value and arg.value[0] or None
 
 
-@_command(1, 'ix')
+@_command(1, 'ix', returns='item', stream=streams.index)
 def at_index(arg, index):
     """ %s N \t\t -- get the N-th element/character from list/string. """
     try:
@@ -103,38 +214,39 @@ def at_index(arg, index):
         return None
 
 
-@_command(1, 'j')
+@_command(1, 'j', returns='str')
 def at_join(arg, sep):
     """ %s SEPARATOR \t -- concatenate a list/string with intervening occurrences of SEPARATOR """
     return sep.join(arg.value)
 
 
-@_command(0, 'j_')
+@_command(0, 'j_', returns='str')
 def at_join_(arg):
     """ %s \t\t -- same as join but SEPARATOR set as ' ' """
     return " ".join(arg.value)
 
 
-@_command(1)
+@_command(1, returns='str', prepare=_regexps, batch='[{1}.sub("", v) for v in {0}]')
 def at_kill(arg, regexp):
     """ %s REGEXP \t\t -- replace in a string/list REGEXP to ''. """
     value = text_type(arg)
-    return re.sub(regexp, "", value)
+    return regexp.sub("", value)
 
 
-@_command()
+@_command(returns='item', stream=streams.last)
 def at_last(arg):
     """ %s \t\t\t -- get last element/character of incoming list/string. """
-    return arg.value[-1]
+    return arg.value[-1] if arg.value else None
 
 
-@_command(0, 'len')
+@_command(0, 'len', returns='str', inline='text_type(len({0}))',
+          stream=streams.length)
 def at_length(arg):
     """ %s \t\t -- return length of list/string. """
     return text_type(len(arg.value))
 
 
-@_command(0, 'l')
+@_command(0, 'l', returns='str', inline='{0}.lower()')
 def at_lower(arg):
     """ %s \t\t -- make the string is lowercase """
     value = text_type(arg)
@@ -147,14 +259,26 @@ def at_map(arg, func, *params):
     return [func(el, *params) for el in arg.value]
 
 
-@_command(0, 'nc')
+@_command(0, returns='item', stream=streams.maximum)
+def at_max(arg):
+    """ %s \t\t\t -- return the maximal number of list. """
+    return streams.maximum(arg.value)
+
+
+@_command(0, returns='item', stream=streams.minimum)
+def at_min(arg):
+    """ %s \t\t\t -- return the minimal number of list. """
+    return streams.minimum(arg.value)
+
+
+@_command(0, 'nc', returns='str')
 def at_nocolor(arg):
     """ %s \t\t -- Remove ansi colors from string. """
     value = text_type(arg)
     return ANSI.re.sub('', value)
 
 
-@_command(1, '!=')
+@_command(1, '!=', returns='str', batch='[v for v in {0} if v != {1}]')
 def at_notequal(arg, pattern):
     """ %s PATTERN \t -- return None if arg is equal to PATTERN. """
     value = text_type(arg)
@@ -162,49 +286,50 @@ def at_notequal(arg, pattern):
         return value
 
 
-@_command(1, 'ng')
+@_command(1, 'ng', returns='same', prepare=_regexps,
+          batch='[v for v in {0} if not {1}.search(v)]')
 def at_notgrep(arg, regexp):
     """ %s REGEXP \t -- filter results by REGEXP. Leave ungrepped """
     value = text_type(arg.value)
-    if not re.search(regexp, value):
+    if not regexp.search(value):
         return arg.value
 
 
-@_command(2, 'r', 'sub')
+@_command(2, 'r', 'sub', returns='str', inline='{0}.replace({1}, {2})')
 def at_replace(arg, p1, p2):
     """ %s FROM TO \t -- replace in a string/list FROM to TO. """
     value = text_type(arg)
     return value.replace(p1, p2)
 
 
-@_command(0, 'rev')
+@_command(0, 'rev', returns='same')
 def at_reverse(arg):
     """ %s \t\t -- reverse list/string. """
     return arg.value[::-1]
 
 
-@_command(1, 'rs', 'rtrim')
+@_command(1, 'rs', 'rtrim', returns='str', inline='{0}.rstrip({1})')
 def at_rstrip(arg, pattern):
     """ %s PATTERN -- return the string with trailing PATTERN removed. """
     value = text_type(arg)
     return value.rstrip(pattern)
 
 
-@_command(1, 'g')
+@_command(1, 'g', returns='same', prepare=_regexps, batch='[v for v in {0} if {1}.search(v)]')
 def at_grep(arg, regexp):
     """ %s REGEXP \t\t -- filter results by REGEXP """
     value = text_type(arg.value)
-    if re.search(regexp, value):
+    if regexp.search(value):
         return arg.value
 
 
-@_command()
+@_command(stream=streams.sort)
 def at_sort(arg):
     """ %s \t\t\t -- sort list/string. """
-    return list(sorted(arg.value))
+    return sorted(arg.value)
 
 
-@_command(1, 'sp')
+@_command(1, 'sp', returns='list')
 def at_split(arg, p):
     """ %s SEPARATOR \t -- return a list of the substrings of the string splited by SEPARATOR """
     value = text_type(arg)
@@ -214,40 +339,73 @@ def at_split(arg, p):
         return None
 
 
-@_command(0, 'sp_')
+@_command(0, 'sp_', returns='list', inline='{0}.split()')
 def at_split_(arg):
     """ %s \t\t -- same as split by splited a string by whitespace characters """
     value = text_type(arg)
     return value.split()
 
 
-@_command(1, 's', 'trim')
+@_command(1, 's', 'trim', returns='str', inline='{0}.strip({1})')
 def at_strip(arg, pattern):
     """ %s PATTERN \t -- return the string with leading and trailing PATTERN removed. """
     value = text_type(arg)
     return value.strip(pattern)
 
 
-@_command(0, 's_', 'trim_')
+@_command(0, 's_', 'trim_', returns='str', inline='{0}.strip()')
 def at_strip_(arg):
     """ %s \t -- same as strip but trims a whitespaces. """
     value = text_type(arg)
     return value.strip()
 
 
-@_command(0, 't')
+@_command(0, returns='str', stream=streams.total)
+def at_sum(arg):
+    """ %s \t\t\t -- return the sum of numbers of list. """
+    return streams.total(arg.value)
+
+
+@_command(0, 't', returns='same', stream=streams.tail)
 def at_tail(arg):
     """ %s \t\t -- extract the elements after the head of a list """
     return arg.value[1:]
 
 
-@_command(1)
+@_command(1, returns='same', stream=streams.take)
 def at_take(arg, length):
     """ %s N \t\t -- take N elements from list/string. """
     return arg.value[:int(length)]
 
 
-@_command(0, 'u')
+@_command(1, returns='list', stream=streams.topk)
+def at_topk(arg, num):
+    """ %s N \t\t -- return N most common elements as "COUNT ELEMENT" (approximate with --approx). """ # noqa
+    return streams.topk(arg.value, num)
+
+
+@_command(0, returns='list', stream=streams.unique)
+def at_uniq(arg):
+    """ %s \t\t\t -- remove repeated elements, keep the first ones. """
+    return list(streams.unique(arg.value))
+
+
+@_command(1, returns='same', pure=False, refs=lambda template, seen: template.numbers,
+          prepare=lambda key: _templates(key) + [streams.Seen()])
+def at_unique(arg, template, seen):
+    """ %s KEY \t\t -- drop values which KEY (a format string: "@", "#1 @") was seen before. """
+    if seen.first(template.render(arg)):
+        return arg.value
+
+
+@_command(0, returns='same', pure=False, prepare=lambda: [streams.Seen()])
+def at_unique_(arg, seen):
+    """ %s \t\t -- same as unique but the KEY is the value, keep the first occurrences. """
+    if seen.first(text_type(arg)):
+        return arg.value
+
+
+@_command(0, 'u', returns='str', inline='{0}.upper()')
 def at_upper(arg):
     """ %s \t\t -- make the string is uppercase. """
     value = text_type(arg)
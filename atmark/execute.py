@@ -0,0 +1,138 @@
+""" Run results as shell commands (instead of `| sh`). """
+import subprocess
+import sys
+from collections import deque
+
+from .utils import PY2, string_types, text_type
+
+
+SHELL = '/bin/sh'
+
+
+# Every command runs in its own subshell: `exit`, `cd`, variables and syntax
+# errors of a command don't affect the next ones
+LOOP = 's=0; for c do (eval "$c") || s=$?; done; exit $s'
+
+
+def script(commands):
+    """ Get the arguments of the shell which runs the commands one by one and
+    exits with the last failed status.
+
+    """
+    if len(commands) == 1:
+        return ['-c', commands[0]]
+    return ['-c', LOOP, 'sh'] + list(commands)
+
+
+def run(args, shell=SHELL):
+    """ Run the shell and return its status, stdout and stderr. """
+    proc = subprocess.Popen(
+        [shell] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    out, err = proc.communicate(b'')
+    return proc.returncode, out, err
+
+
+def _attempt(args, shell=SHELL):
+    """ Return the error of the script instead of raising it: `error_callback`
+    of the pool is missing on Python 2.
+
+    """
+    try:
+        return run(args, shell)
+    except Exception as exc: # noqa
+        return exc
+
+
+class Executor(object):
+
+    """ Run the results as shell commands in `jobs` threads.
+
+    Every `size` results are run by a single shell (as `xargs -n`).
+    The output of the scripts is captured and printed in the order of the
+    results, or as soon as a script is done when `ordered` is False. No
+    more than two scripts per a thread are waiting.
+
+    """
+
+    def __init__(self, jobs=1, size=1, ordered=True, shell=SHELL, stdout=None, stderr=None):
+        from multiprocessing.pool import ThreadPool
+
+        if PY2:
+            from Queue import Queue
+        else:
+            from queue import Queue
+
+        self.jobs = max(jobs, 1)
+        self.size = max(size, 1)
+        self.ordered = ordered
+        self.shell = shell
+        self.stdout = stdout or getattr(sys.stdout, 'buffer', sys.stdout)
+        self.stderr = stderr or getattr(sys.stderr, 'buffer', sys.stderr)
+        self.pool = ThreadPool(self.jobs)
+        self.commands = []
+        self.pending = deque()
+        self.ready = Queue()
+        self.scripts = self.failed = 0
+        self.status = 0
+
+    def write(self, arg):
+        self.commands.append(arg if isinstance(arg, string_types) else text_type(arg))
+        if len(self.commands) >= self.size:
+            self.submit()
+
+    def submit(self):
+        args, self.commands = script(self.commands), []
+        self.scripts += 1
+        if self.ordered:
+            self.pending.append(self.pool.apply_async(run, (args, self.shell)))
+        else:
+            self.pending.append(None)
+            self.pool.apply_async(_attempt, (args, self.shell), callback=self.ready.put)
+
+        while len(self.pending) >= self.jobs * 2 or (
+                not self.ordered and self.pending and not self.ready.empty()):
+            self.report(self.result())
+
+    def result(self):
+        if self.ordered:
+            return self.pending.popleft().get()
+        self.pending.popleft()
+        result = self.ready.get()
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def report(self, result):
+        status, out, err = result
+        if out:
+            self.stdout.write(out)
+            self.stdout.flush()
+        if err:
+            self.stderr.write(err)
+            self.stderr.flush()
+        if status:
+            self.failed += 1
+            self.status = 1
+
+    def flush(self):
+        """ Run the collected commands and wait for the scripts. """
+        if self.commands:
+            self.submit()
+        while self.pending:
+            self.report(self.result())
+
+    def close(self, finalize=True):
+        """ Wait for the scripts and print the number of the failed ones. """
+        if not finalize:
+            self.pool.terminate()
+            self.pool.join()
+            return
+
+        self.flush()
+        self.pool.close()
+        self.pool.join()
+        if self.failed:
+            self.stderr.write(("atmark: %d of %d scripts failed\n" % (
+                self.failed, self.scripts)).encode('utf-8'))
+            self.stderr.flush()
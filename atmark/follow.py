@@ -0,0 +1,203 @@
+""" Follow a growing file (`@ --follow FILE`). """
+import json
+import os
+import sys
+from time import sleep, time
+
+from .utils import BLOCK_SIZE
+
+
+INTERVAL = 1.0
+
+# inotify(7) events of the directory: the file is written, truncated,
+# moved or created
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class Poll(object):
+
+    """ Wait for changes by sleeping (when inotify is not available). """
+
+    interval = 0.25
+
+    def wait(self, timeout):
+        sleep(min(timeout, self.interval))
+
+    def close(self):
+        pass
+
+
+class Inotify(object):
+
+    """ Wait for changes in the directory of the file by inotify (Linux).
+
+    The events are not parsed: the file is checked after any of them, and
+    at least every `timeout` seconds in case an event is missed.
+
+    """
+
+    def __init__(self, path):
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()),
+                                  IN_MASK) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch")
+
+    def wait(self, timeout):
+        from select import select
+
+        select([self.fd], [], [], timeout)
+        try:
+            while os.read(self.fd, 1 << 12):
+                pass
+        except EnvironmentError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(path):
+    """ Get inotify watcher of the file or polling one. """
+    try:
+        return Inotify(path)
+    except (AttributeError, EnvironmentError):
+        return Poll()
+
+
+class Checkpoint(object):
+
+    """ Store the inode of the file and the offset of its processed lines. """
+
+    def __init__(self, path):
+        self.path = path
+        self.saved = None
+
+    def load(self):
+        try:
+            with open(self.path) as stream:
+                data = json.load(stream)
+            return data['inode'], data['offset']
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            return None, 0
+
+    def save(self, inode, offset):
+        if (inode, offset) == self.saved:
+            return
+        with open(self.path + '.tmp', 'w') as stream:
+            json.dump(dict(inode=inode, offset=offset), stream)
+        os.rename(self.path + '.tmp', self.path)
+        self.saved = inode, offset
+
+
+def _open(path):
+    try:
+        return open(path, 'rb')
+    except EnvironmentError:
+        return None
+
+
+def follow(path, checkpoint=None, flush=None, encoding=None, errors='strict',
+           block_size=BLOCK_SIZE, interval=INTERVAL):
+    """ Iterate over the lines of the file and wait for the appended ones.
+
+    A rotated file (renamed or removed, as by logrotate) is read to the end
+    and the new one is read from the start; a truncated file is read again
+    from the start. The last line is taken only when it's complete.
+
+    With `checkpoint` the offset of the processed lines is stored to the
+    file every `interval` seconds, when there is nothing to read and when
+    the iteration stops, and the next run starts from it (when it's the
+    same file). A line is processed when the next one is taken, so a line
+    which processing is interrupted is read again. `flush` is called
+    before the checkpoint is saved (at the end as well) to write the results
+    of the lines.
+
+    """
+    encoding = encoding or getattr(sys.stdin, 'encoding', None) or 'utf-8'
+    checkpoint = checkpoint and Checkpoint(checkpoint)
+    inode, done = checkpoint.load() if checkpoint else (None, 0)
+    changes = watcher(path)
+    stream = None
+    saved = time()
+
+    def save():
+        if flush:
+            flush()
+        if checkpoint:
+            checkpoint.save(inode, done)
+
+    try:
+        while True:
+            if stream is None:
+                stream = _open(path)
+                if stream is None:
+                    changes.wait(interval)
+                    continue
+
+                # A new file is read from the start
+                stat = os.fstat(stream.fileno())
+                if stat.st_ino != inode or stat.st_size < done:
+                    inode, done = stat.st_ino, 0
+                stream.seek(done)
+                pos, tail = done, b''
+
+            block = stream.read(block_size)
+            if block:
+                lines = (tail + block).split(b'\n')
+                tail = lines.pop()
+                for line in lines:
+                    pos += len(line) + 1
+                    yield line.rstrip(b'\r').decode(encoding, errors)
+                    done = pos
+
+                if time() - saved >= interval:
+                    save()
+                    saved = time()
+                continue
+
+            save()
+            try:
+                current = os.stat(path).st_ino
+            except EnvironmentError:
+                current = None
+
+            # Truncated
+            if os.fstat(stream.fileno()).st_size < pos + len(tail):
+                stream.seek(0)
+                pos = done = 0
+                tail = b''
+                continue
+
+            # Rotated: the rest of the old file is read already
+            if current != inode:
+                if tail:
+                    yield tail.rstrip(b'\r').decode(encoding, errors)
+                stream.close()
+                stream, inode, done = None, None, 0
+                if current is None:
+                    changes.wait(interval)
+                continue
+
+            changes.wait(interval)
+    finally:
+        if stream is not None:
+            stream.close()
+        changes.close()
+        if flush:
+            flush()
+        if checkpoint and inode is not None:
+            checkpoint.save(inode, done)
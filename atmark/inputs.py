@@ -0,0 +1,185 @@
+""" Read files and compressed streams. """
+import sys
+from itertools import chain
+
+from .utils import BLOCK_SIZE, PY2, iter_lines, read_blocks
+
+
+QUEUE_SIZE = 8
+
+# Magic bytes of the compressed streams and the modules to decompress them.
+# "BZh" is a common text, so bzip2 is detected by the whole header: the block
+# size (1-9) and the magic of the first block or of the end of an empty stream
+MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+) + tuple(
+    (b'BZh' + level.encode('ascii') + marker, 'bz2')
+    for level in '123456789'
+    for marker in (b'1AY&SY', b'\x17\x72\x45\x38\x50\x90'))
+
+
+def _partial(head):
+    """ Whether the head is shorter than magic bytes which it starts. """
+    return any(len(head) < len(magic) and magic.startswith(head) for magic, _ in MAGIC)
+
+
+def _head(blocks):
+    """ Get the first blocks until the compression can be detected. """
+    head = b''
+    for block in blocks:
+        head += block
+        if not _partial(head):
+            break
+    return head
+
+
+def detect(block):
+    """ Get a name of the compression by the first bytes of the stream. """
+    for magic, name in MAGIC:
+        if block[:len(magic)] == magic:
+            return name
+
+
+def _decompressor(name):
+    if name == 'gzip':
+        import zlib
+
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    if name == 'bz2':
+        import bz2
+
+        return bz2.BZ2Decompressor()
+
+    if name == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            from backports import lzma
+
+        return lzma.LZMADecompressor()
+
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("Install `zstandard` to read .zst streams")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def decompress(blocks):
+    """ Decompress the blocks when they start with known magic bytes.
+
+    Concatenated compressed streams (as `cat a.gz b.gz`) are decompressed
+    one by one.
+
+    """
+    blocks = iter(blocks)
+    block = _head(blocks)
+    name = detect(block)
+    if name is None:
+        yield block
+        for block in blocks:
+            yield block
+        return
+
+    decompressor = _decompressor(name)
+    while block:
+        if getattr(decompressor, 'eof', False):
+            decompressor = _decompressor(name)
+        data = decompressor.decompress(block)
+        if data:
+            yield data
+        block = getattr(decompressor, 'unused_data', b'') or next(blocks, b'')
+
+    data = getattr(decompressor, 'flush', lambda: b'')()
+    if data:
+        yield data
+
+
+def uncompressed(blocks, queue_size=QUEUE_SIZE):
+    """ Decompress the blocks in a background thread if they are compressed. """
+    blocks = iter(blocks)
+    block = _head(blocks)
+    if detect(block) is not None:
+        blocks = prefetch(decompress(chain([block], blocks)), queue_size)
+    elif block:
+        yield block
+    for block in blocks:
+        yield block
+
+
+class _Error(object):
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def prefetch(blocks, size=QUEUE_SIZE):
+    """ Read the blocks in a background thread to a queue of the given size.
+
+    The thread starts at once, so the next files are decompressed while the
+    current one is processed.
+
+    """
+    if PY2:
+        from Queue import Queue
+    else:
+        from queue import Queue
+
+    from threading import Thread
+
+    queue = Queue(size)
+
+    def worker():
+        try:
+            for block in blocks:
+                queue.put(block)
+        except Exception as exc: # noqa
+            queue.put(_Error(exc))
+        queue.put(None)
+
+    thread = Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+
+    def gen():
+        while True:
+            block = queue.get()
+            if block is None:
+                break
+            if isinstance(block, _Error):
+                raise block.exc
+            yield block
+
+    return gen()
+
+
+def _read(path, block_size):
+    if path == '-':
+        for block in decompress(read_blocks(sys.stdin, block_size)):
+            yield block
+        return
+
+    with open(path, 'rb') as stream:
+        for block in decompress(read_blocks(stream, block_size)):
+            yield block
+
+
+def read_files(paths, encoding=None, errors='strict', block_size=BLOCK_SIZE,
+               queue_size=QUEUE_SIZE, concurrent=1):
+    """ Iterate over lines of the files (compressed or not) one by one.
+
+    Every file is read and decompressed by a background thread; `concurrent`
+    files are read ahead at once. The lines keep the order of the files.
+
+    """
+    encoding = encoding or getattr(sys.stdin, 'encoding', None) or 'utf-8'
+    paths = list(paths)
+    pending = []
+    while paths or pending:
+        while paths and len(pending) < max(concurrent, 1):
+            pending.append(prefetch(_read(paths.pop(0), block_size), queue_size))
+        for line in iter_lines(pending.pop(0), encoding, errors):
+            yield line
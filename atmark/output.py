@@ -0,0 +1,218 @@
+""" Output sinks. """
+import io
+import os
+import signal
+import stat
+import sys
+from collections import OrderedDict
+from time import time
+
+from .pipeline import Arg
+from .utils import ANSI, isatty, string_types, text_type
+
+
+BUFFER_SIZE = 1 << 16
+FLUSH_INTERVAL = 1.0
+MAX_OPEN = 128
+PARTITIONS_BUFFER_SIZE = 1 << 24
+
+
+def watch(stream=None):
+    """ Send SIGPIPE to the process as soon as the reader of the output pipe
+    is gone, so `@ grep RARE | head -1` stops reading the input even when
+    nothing is written.
+
+    A thread waits for the error state of the pipe, which `poll` reports
+    without writing to it.
+
+    """
+    stream = stream or sys.stdout
+    try:
+        fd = stream.fileno()
+        if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+            return
+        from select import poll
+    except (AttributeError, ImportError, EnvironmentError, ValueError):
+        return
+
+    from threading import Thread
+
+    def wait():
+        errors = poll()
+        errors.register(fd, 0)
+        errors.poll()
+        os.kill(os.getpid(), signal.SIGPIPE)
+
+    thread = Thread(target=wait)
+    thread.daemon = True
+    thread.start()
+
+
+class Output(object):
+
+    """ Collect results and write them to a stream by large chunks.
+
+    The buffer is flushed when it grows over `size` characters or, by the
+    next result, when `interval` seconds passed since the last flush: with
+    rare results the latency is bounded only by line buffered output, which
+    flushes every line (default for terminals).
+
+    """
+
+    def __init__(self, stream=None, line_buffered=None, size=BUFFER_SIZE,
+                 interval=FLUSH_INTERVAL):
+        self.stream = stream or sys.stdout
+        self.tty = isatty(self.stream)
+        if line_buffered is None:
+            line_buffered = self.tty
+        self.size = 0 if line_buffered else size
+        self.interval = interval
+        self.buffer = []
+        self.length = 0
+        self.flushed = time()
+
+    def write(self, message):
+        if not isinstance(message, string_types):
+            message = text_type(message)
+
+        # Skip the regexp when the message has no escape sequences at all
+        if not self.tty and '\033' in message:
+            message = ANSI.re.sub('', message)
+
+        self.buffer.append(message)
+        self.length += len(message) + 1
+        if self.length > self.size or time() - self.flushed > self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.append('')
+            self.stream.write('\n'.join(self.buffer))
+            self.buffer = []
+            self.length = 0
+        self.stream.flush()
+        self.flushed = time()
+
+    def close(self, finalize=True):
+        """ Write the rest of the results (on errors too, as the results
+        printed before an error are printed by an unbuffered output).
+
+        """
+        self.flush()
+
+
+class OutputError(ValueError):
+
+    """ A result can't be written to the path of the template. """
+
+
+class PartitionedOutput(object):
+
+    """ Write results to the files, which paths are rendered by the template.
+
+    Results are collected by the files and written when all the buffers
+    grow over `size` characters. No more than `max_open` files are open at
+    once: the least recently used one is closed to open another. The files
+    are written as hidden temporary files (.atmark-XXX) in the directories
+    of their paths and renamed to them when the output is closed.
+
+    With `append` (for `--follow`, which output has no end) the results are
+    appended to the files at once and every flush writes them to disk.
+
+    """
+
+    def __init__(self, template, max_open=MAX_OPEN, size=PARTITIONS_BUFFER_SIZE,
+                 append=False):
+        self.template = template
+        self.max_open = max(max_open, 1)
+        self.size = size
+        self.append = append
+        self.buffers = dict()
+        self.length = 0
+        self.handles = OrderedDict()
+        self.temps = dict()
+
+    def write(self, arg):
+        # Results of `@@` are values without the history
+        if self.template.numbers and not isinstance(arg, Arg):
+            arg = Arg(arg)
+        path = self.template.render(arg)
+        if not path or path[-1] in (os.sep, os.altsep, '/'):
+            raise OutputError("the path of the result %r is not a file: %r" % (
+                text_type(arg), path))
+        message = arg if isinstance(arg, string_types) else text_type(arg)
+        if '\033' in message:
+            message = ANSI.re.sub('', message)
+
+        buffer = self.buffers.get(path)
+        if buffer is None:
+            buffer = self.buffers[path] = []
+        buffer.append(message)
+        self.length += len(message) + 1
+        if self.length > self.size:
+            self.flush()
+
+    def flush(self):
+        for path, buffer in self.buffers.items():
+            buffer.append('')
+            self.open(path).write('\n'.join(buffer))
+        self.buffers = dict()
+        self.length = 0
+        if self.append:
+            for handle in self.handles.values():
+                handle.flush()
+
+    def open(self, path):
+        """ Get a handle of the file from the pool. """
+        handle = self.handles.pop(path, None)
+        if handle is None:
+            if len(self.handles) >= self.max_open:
+                _, evicted = self.handles.popitem(last=False)
+                evicted.close()
+
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            if self.append:
+                handle = io.open(path, 'a', encoding='utf-8', newline='\n')
+            elif path in self.temps:
+                handle = io.open(self.temps[path], 'a', encoding='utf-8', newline='\n')
+            else:
+                import tempfile
+
+                fd, self.temps[path] = tempfile.mkstemp(dir=dirname or '.', prefix='.atmark-')
+                handle = io.open(fd, 'w', encoding='utf-8', newline='\n')
+
+        self.handles[path] = handle
+        return handle
+
+    def close(self, finalize=True):
+        """ Rename the written files to their paths (remove them on errors).
+
+        Every file is renamed even when some of them fail, the failed ones
+        are reported after that.
+
+        """
+        if finalize:
+            self.flush()
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+        # Temporary files are private (0600), the results get the usual mode
+        umask = os.umask(0)
+        os.umask(umask)
+        failed = []
+        for path, temp in sorted(self.temps.items()):
+            try:
+                if finalize:
+                    os.chmod(temp, 0o666 & ~umask)
+                    os.rename(temp, path)
+                else:
+                    os.remove(temp)
+            except EnvironmentError as exc:
+                failed.append("%s: %s" % (path, exc.strerror or exc))
+        self.temps.clear()
+        if failed and finalize:
+            raise OutputError("failed to write %d of the files:\n  %s" % (
+                len(failed), "\n  ".join(failed)))
@@ -0,0 +1,93 @@
+""" Process lines in a pool of worker processes. """
+from collections import deque
+from itertools import islice
+
+from .pipeline import processor
+from .utils import PY2, text_type
+
+
+CHUNK_SIZE = 10000
+
+_process = None
+
+
+def _initialize(tokens, keep, compiled, memo=None):
+    global _process
+    _process = processor(tokens, keep, compiled, memo)
+
+
+def _run(lines):
+    results = []
+    for line in lines:
+        arg = _process(line)
+        if arg.value is not None:
+            results.append(text_type(arg))
+    return results
+
+
+def _attempt(lines):
+    """ Return the error of the chunk instead of raising it: `error_callback`
+    of the pool is missing on Python 2.
+
+    """
+    try:
+        return _run(lines)
+    except Exception as exc: # noqa
+        return exc
+
+
+def chunks(stream, size=CHUNK_SIZE):
+    """ Split the stream to lists of the given size. """
+    while True:
+        chunk = list(islice(stream, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def process(tokens, stream, jobs, keep=None, compiled=True, unordered=False,
+            size=CHUNK_SIZE, memo=None):
+    """ Process the stream by chunks in `jobs` processes.
+
+    Results are yielded as strings in the input order, or as soon as a chunk
+    is done when `unordered` is set. No more than two chunks per a worker
+    are read ahead. Every worker has its own cache of `memo` lines.
+
+    """
+    from multiprocessing import Pool
+
+    if PY2:
+        from Queue import Queue
+    else:
+        from queue import Queue
+
+    pool = Pool(jobs, _initialize, (tokens, keep, compiled, memo))
+    pending = deque()
+    ready = Queue()
+
+    def results():
+        if unordered:
+            pending.popleft()
+            result = ready.get()
+            if isinstance(result, BaseException):
+                raise result
+            return result
+        return pending.popleft().get()
+
+    try:
+        for chunk in chunks(stream, size):
+            if unordered:
+                pending.append(pool.apply_async(_attempt, (chunk,), callback=ready.put))
+            else:
+                pending.append(pool.apply_async(_run, (chunk,)))
+
+            if len(pending) >= jobs * 2:
+                for result in results():
+                    yield result
+
+        while pending:
+            for result in results():
+                yield result
+
+    finally:
+        pool.terminate()
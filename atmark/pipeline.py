@@ -0,0 +1,394 @@
+""" Process values by a chain of commands. """
+from collections import OrderedDict
+
+from .utils import text_type
+
+
+class Arg(object):
+
+    """ Store changes history.
+
+    When `keep` is given only the states with these numbers are stored.
+    The record is a value parsed from JSON or CSV (see `records`).
+
+    """
+
+    __slots__ = 'start', 'value', 'history', 'keep', 'step', 'record'
+
+    def __init__(self, value="", keep=None):
+        self.start = value
+        self.value = value
+        self.keep = keep
+        self.step = 0
+        self.record = None
+        self.history = {0: value} if keep is None or 0 in keep else {}
+
+    def __repr__(self):
+        return " > ".join(text_type(h) for _, h in sorted(self.history.items()))
+
+    def __str__(self):
+        if isinstance(self.value, list):
+            return "".join(self.value)
+        return text_type(self.value)
+
+    __unicode__ = __str__
+
+    def process(self, tokens):
+        for func, params in tokens:
+            self.update(func(self, *params))
+            if self.value is None:
+                break
+        return self
+
+    def update(self, value):
+        self.value = value
+        self.step += 1
+        if self.keep is None or self.step in self.keep:
+            self.history[self.step] = value
+
+
+def history_refs(tokens):
+    """ Get numbers of the history states which are used by the tokens. """
+    refs = set()
+    for func, params in tokens:
+        get_refs = getattr(func, 'refs', None)
+        if get_refs:
+            refs.update(get_refs(*params))
+    return refs
+
+
+def _fuse_split(split, params, func, args):
+    """ Get a field command instead of a split followed by a selection. """
+    from . import commands as c
+
+    field, fields = c.at_field, c.at_fields
+    if split is c.at_split_:
+        field, fields, params = c.at_field_, c.at_fields_, []
+    try:
+        if func is c.at_index:
+            return field, params + [int(args[0])]
+        if func is c.at_last:
+            return field, params + [-1]
+        if func is c.at_take and int(args[0]) > 0:
+            return fields, params + [(0, int(args[0]))]
+    except ValueError:
+        return None
+    if func is c.at_head:
+        # `head` returns None for an empty first field
+        return (field, params + [0, True]) if params else (field, [0])
+
+
+def _label(param):
+    """ Get the param as it was given (prepared params are compiled). """
+    for attr in ('string', 'pattern'):
+        if hasattr(param, attr):
+            return text_type(getattr(param, attr))
+    if callable(param):
+        return param.__name__[3:]
+    return text_type(param)
+
+
+def describe(func, params):
+    """ Get the command as it was typed: 'grep ^foo'. """
+    return " ".join([func.__name__[3:]] + [_label(param) for param in params])
+
+
+def _fuse_splits(tokens, notes):
+    from .commands import at_split, at_split_
+
+    result = []
+    pos = 0
+    while pos < len(tokens):
+        func, params = tokens[pos]
+        if func in (at_split, at_split_) and pos + 1 < len(tokens):
+            fused = _fuse_split(func, list(params), *tokens[pos + 1])
+            if fused:
+                notes.append("fused %s, %s to %s" % (
+                    describe(func, params), describe(*tokens[pos + 1]), describe(*fused)))
+                result.append(fused)
+                pos += 2
+                continue
+        result.append((func, params))
+        pos += 1
+    return result
+
+
+def _drop_dead(tokens, notes):
+    """ Drop the commands which results are overwritten by a format without '@'. """
+    from . import commands as c
+
+    total = (c.at_format, c.at_replace, c.at_upper, c.at_lower, c.at_strip, c.at_strip_,
+             c.at_rstrip, c.at_kill, c.at_nocolor, c.at_length, c.at_reverse)
+    result = []
+    for func, params in tokens:
+        if func is c.at_format and all(num is not None for _, num in params[0].refs):
+            while result and result[-1][0] in total:
+                notes.append("dropped %s, overwritten by %s" % (
+                    describe(*result.pop()), describe(func, params)))
+        result.append((func, params))
+    return result
+
+
+def _dedupe(tokens, notes):
+    """ Drop the repeated idempotent commands (`upper upper`, `strip x rstrip x`). """
+    from . import commands as c
+
+    idempotent = (c.at_upper, c.at_lower, c.at_strip, c.at_strip_, c.at_rstrip, c.at_filter,
+                  c.at_grep, c.at_notgrep, c.at_equal, c.at_notequal)
+    result = []
+    for func, params in tokens:
+        if result and [_label(p) for p in result[-1][1]] == [_label(p) for p in params]:
+            prev = result[-1][0]
+            if func is prev and func in idempotent or (
+                    prev is c.at_strip and func is c.at_rstrip):
+                notes.append("dropped repeated %s" % describe(func, params))
+                continue
+            if prev is c.at_rstrip and func is c.at_strip:
+                notes.append("dropped %s, repeated by %s" % (
+                    describe(*result.pop()), describe(func, params)))
+        result.append((func, params))
+    return result
+
+
+def _literal(regexp):
+    """ Get the pattern of the regexp when it matches itself only. """
+    import re
+
+    if type(regexp) is not type(re.compile('')) or regexp.flags & ~re.UNICODE:
+        return None
+    if any(char in '\\.^$*+?{}[]|()' for char in regexp.pattern):
+        return None
+    return regexp.pattern
+
+
+def _commutes(filter_, fparams, func, params):
+    """ Check the filter gives the same results before the string command.
+
+    A literal keeps matching when the command doesn't touch its characters;
+    `== P` keeps matching when FROM and TO are not in P (so the replaced
+    value can't be P).
+
+    """
+    from . import commands as c
+
+    if filter_ in (c.at_equal, c.at_notequal):
+        return func is c.at_replace and all(p and p not in fparams[0] for p in params)
+
+    literal = _literal(fparams[0])
+    if literal is None:
+        return False
+    if func is c.at_replace:
+        old, new = params
+        return bool(old) and (bool(new) or len(literal) == 1) and not (
+            set(literal) & set(old + new))
+    if func in (c.at_upper, c.at_lower):
+        return all(char < '\x80' and not char.isalpha() for char in literal)
+    if func in (c.at_strip, c.at_rstrip):
+        return not set(literal) & set(params[0])
+    if func is c.at_strip_:
+        return not any(char.isspace() for char in literal)
+    return False
+
+
+def _hoist(tokens, kind, notes):
+    """ Move the filters before the string commands they commute with. """
+    from . import commands as c
+
+    filters = (c.at_grep, c.at_notgrep, c.at_equal, c.at_notequal)
+    result, kinds = [], []
+    for func, params in tokens:
+        pos = len(result)
+        if func in filters:
+            while pos and kinds[pos - 1] == 'str' and _commutes(func, params, *result[pos - 1]):
+                pos -= 1
+        if pos < len(result):
+            notes.append("moved %s before %s" % (describe(func, params), describe(*result[pos])))
+            kinds.insert(pos, 'str')
+        else:
+            kinds.append(kind)
+        result.insert(pos, (func, params))
+        kind = _returns(func, kind)
+    return result
+
+
+def optimize(tokens, keep, notes=None):
+    """ Rewrite the tokens to a faster plan with the same results.
+
+    * `split`/`split_` followed by `index`, `head`, `last` or `take` become
+      the field commands, which don't split the whole string;
+    * commands which results are overwritten by a format without '@' are
+      dropped, as well as repeated idempotent ones (`upper upper`);
+    * `grep`, `ng`, `==` and `!=` are moved before the string commands
+      when they provably give the same results (`replace a b grep ERROR`).
+
+    The rewrites change the numbers of the history states, so only the
+    commands after the last referenced state are rewritten (and never in
+    debug, where `keep` is None). Descriptions of the rewrites are appended
+    to `notes`.
+
+    """
+    if keep is None or not tokens:
+        return tokens
+
+    notes = [] if notes is None else notes
+    last_ref = max(keep) if keep else 0
+    head, tail = list(tokens[:last_ref]), list(tokens[last_ref:])
+
+    kind = 'str'
+    for func, _ in head:
+        kind = _returns(func, kind)
+
+    tail = _fuse_splits(tail, notes)
+    tail = _drop_dead(tail, notes)
+    tail = _dedupe(tail, notes)
+    tail = _hoist(tail, kind, notes)
+    return head + tail
+
+
+def _returns(func, kind):
+    """ Get a type of the command's result by a type of the given value. """
+    returns = getattr(func, 'returns', None)
+    if returns == 'same':
+        return kind
+    if returns == 'item':
+        return kind in ('str', 'list') and 'str' or None
+    return returns
+
+
+def compile_tokens(tokens, keep=None):
+    """ Compile the tokens to a single function which processes a line.
+
+    Commands with an `inline` expression are inserted into the function's
+    code while the processed value is known to be a string. Other commands
+    are called as `Arg.process` calls them. Only the history states listed
+    in `keep` are stored (all of them by default).
+
+    """
+    namespace = dict(Arg=Arg, text_type=text_type, keep=keep)
+    code = [
+        "def pipeline(line):",
+        "    arg = Arg(line, keep)",
+        "    history = arg.history",
+        "    value = line",
+    ]
+    kind = 'str'
+    for num, (func, params) in enumerate(tokens):
+        names = []
+        for pnum, param in enumerate(params):
+            name = "p%d_%d" % (num, pnum)
+            namespace[name] = param
+            names.append(name)
+
+        inline = kind == 'str' and getattr(func, 'inline', None)
+        if inline:
+            code.append("    value = " + inline.format('value', *names))
+        else:
+            name = "f%d" % num
+            namespace[name] = func
+            code.append("    arg.value = value")
+            code.append("    value = %s(%s)" % (name, ", ".join(['arg'] + names)))
+
+        if keep is None or num + 1 in keep:
+            code.append("    history[%d] = value" % (num + 1))
+
+        if not inline:
+            code.append("    if value is None:")
+            code.append("        arg.value = value")
+            code.append("        return arg")
+
+        kind = _returns(func, kind)
+
+    code.append("    arg.value = value")
+    code.append("    return arg")
+
+    exec(compile("\n".join(code), "<pipeline>", "exec"), namespace)
+    return namespace['pipeline']
+
+
+def compile_batch(tokens):
+    """ Compile the tokens to a function which processes a list of lines.
+
+    Every command is applied to the whole list by a list comprehension: its
+    `batch` expression or its `inline` one for each value. Filters drop the
+    values from the list, so the survivors stay in order. Returns None when
+    a command has none of them or doesn't return a string.
+
+    """
+    namespace = dict(text_type=text_type)
+    code = ["def pipeline(values):"]
+    for num, (func, params) in enumerate(tokens):
+        names = []
+        for pnum, param in enumerate(params):
+            name = "p%d_%d" % (num, pnum)
+            namespace[name] = param
+            names.append(name)
+
+        if _returns(func, 'str') != 'str':
+            return None
+
+        batch = getattr(func, 'batch', None)
+        inline = getattr(func, 'inline', None)
+        if batch:
+            code.append("    values = " + batch.format('values', *names))
+        elif inline:
+            code.append("    values = [%s for v in values]" % inline.format('v', *names))
+        else:
+            return None
+
+    code.append("    return values")
+
+    exec(compile("\n".join(code), "<batch>", "exec"), namespace)
+    return namespace['pipeline']
+
+
+def processor(tokens, keep=None, compiled=True, memo=None):
+    """ Get a function which processes a line by the tokens.
+
+    With `memo` the results of the last `memo` distinct lines are cached
+    when all the commands are pure.
+
+    """
+    if compiled:
+        process = compile_tokens(tokens, keep)
+    else:
+        process = lambda line: Arg(line, keep).process(tokens)
+    if memo and is_pure(tokens):
+        return Memo(process, memo)
+    return process
+
+
+def is_pure(tokens):
+    """ Check results of the tokens depend on the processed value only. """
+    return all(getattr(func, 'pure', True) for func, _ in tokens)
+
+
+class Memo(object):
+
+    """ Cache the processed lines in a LRU cache of the given size. """
+
+    def __init__(self, process, size):
+        self.process = process
+        self.size = size
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __call__(self, line):
+        cache = self.cache
+        arg = cache.get(line)
+        if arg is not None:
+            self.hits += 1
+            self.touch(line)
+            return arg
+
+        self.misses += 1
+        arg = cache[line] = self.process(line)
+        if len(cache) > self.size:
+            cache.popitem(last=False)
+        return arg
+
+    def touch(self, line):
+        """ Mark the line as the most recently used. """
+        try:
+            self.cache.move_to_end(line)
+        except AttributeError:
+            self.cache[line] = self.cache.pop(line)
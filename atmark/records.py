@@ -0,0 +1,134 @@
+""" JSON and CSV records of the lines. """
+from .utils import string_types, text_type
+
+
+MODES = 'json', 'csv'
+_mode = []
+_loads = []
+_header = dict()
+
+
+def set_mode(name):
+    """ Set a format of the records: json or csv. """
+    if name not in MODES:
+        raise ValueError('Unknown records format %r' % name)
+    _mode[:] = [name]
+    return name
+
+
+def loads(text):
+    """ Parse JSON with the fastest available module: orjson, ujson or json. """
+    if not _loads:
+        for name in ('orjson', 'ujson', 'json'):
+            try:
+                _loads[:] = [__import__(name).loads]
+                break
+            except ImportError:
+                continue
+    return _loads[0](text)
+
+
+def dumps(value):
+    from json import dumps
+
+    return dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+class CSVParser(object):
+
+    """ Parse lines by a single csv reader (as an iterator over the given lines). """
+
+    def __init__(self):
+        import csv
+
+        self.line = None
+        self.reader = csv.reader(self)
+        self.error = csv.Error
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.line
+
+    next = __next__
+
+    def parse(self, line):
+        self.line = line
+        try:
+            return next(self.reader)
+        except self.error as exc:
+            raise ValueError(exc)
+
+
+_csv = []
+
+
+def parse_csv(line):
+    if not _csv:
+        _csv.append(CSVParser())
+    return _csv[0].parse(line)
+
+
+def csv_records(lines):
+    """ Join lines of quoted fields with line breaks to records.
+
+    The first record is read at once as the header to get the columns by
+    names.
+
+    """
+    lines = iter(lines)
+
+    def records():
+        for line in lines:
+            while line.count('"') % 2:
+                try:
+                    line += '\n' + next(lines)
+                except StopIteration:
+                    break
+            yield line
+
+    records = records()
+    for header in records:
+        _header.clear()
+        _header.update((name, num) for num, name in enumerate(parse_csv(header)))
+        break
+    return records
+
+
+def record(arg, mode='json'):
+    """ Get the value parsed once as a record (by --json/--csv or `mode`). """
+    value = arg.value
+    cached = arg.record
+    if cached is not None and cached[0] is value:
+        return cached[1]
+
+    if not isinstance(value, string_types):
+        return value
+    mode = _mode and _mode[0] or mode
+    try:
+        parsed = loads(value) if mode == 'json' else parse_csv(value)
+    except ValueError:
+        parsed = None
+    arg.record = value, parsed
+    return parsed
+
+
+def path(spec):
+    """ Split the path of the keys: 'user.name', 'items.0'. """
+    return spec.split('.')
+
+
+def lookup(value, keys):
+    """ Get the nested value by the keys or None. """
+    try:
+        for key in keys:
+            if isinstance(value, list):
+                value = value[_header[key] if key in _header else int(key)]
+            else:
+                value = value[key]
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+    if value is None or isinstance(value, string_types):
+        return value
+    return dumps(value) if isinstance(value, (dict, list, bool)) else text_type(value)
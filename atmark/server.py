@@ -0,0 +1,219 @@
+""" Serve `@` from a warm process (`@ --server`).
+
+Every connection is handled by a forked child, so the commands, compiled
+regexps and parsed chains of the parent are shared by the requests while
+the state of a request (options, stdin) doesn't leak to the others.
+
+"""
+import io
+import os
+import signal
+import socket
+import sys
+import traceback
+from collections import OrderedDict
+
+from .client import BLOCK_SIZE, PY2, decode, is_private, receive, send, socket_path
+
+
+CACHE_SIZE = 256
+
+# Seconds to wait for the request of a client, the next ones wait meanwhile
+REQUEST_TIMEOUT = 5.0
+
+
+class FrameReader(io.RawIOBase):
+
+    """ Read stdin of the client from 'i' frames. """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.data = b''
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.data and not self.eof:
+            kind, data = receive(self.sock)
+            if kind == b'i':
+                self.data = data
+                self.eof = not data
+        size = min(len(buffer), len(self.data))
+        buffer[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+
+class FrameWriter(io.RawIOBase):
+
+    """ Write stdout or stderr to the client in frames of the given type. """
+
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            send(self.sock, self.kind, bytes(data))
+        return len(data)
+
+
+def _text(raw, mode):
+    stream = io.BufferedReader(raw) if mode == 'r' else io.BufferedWriter(raw, BLOCK_SIZE)
+    if PY2:
+        return stream # stdio of Python 2 is binary
+    return io.TextIOWrapper(stream, encoding='utf-8', errors='surrogateescape')
+
+
+def _split(args):
+    """ Split the leading options from the commands without applying them. """
+    from .atmark import OPTIONS
+
+    pos = 0
+    while pos < len(args) and args[pos] in OPTIONS:
+        pos += 2 if OPTIONS[args[pos]][1] else 1
+    return args[:pos], args[pos:]
+
+
+class Server(object):
+
+    """ Accept connections on the Unix socket and fork a child for each one. """
+
+    def __init__(self, path=None, cache_size=CACHE_SIZE):
+        self.path = path or socket_path()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def tokens(self, args, environ):
+        """ Get the parsed commands from the cache (None when they depend on
+        the options of the request).
+
+        """
+        from .atmark import _tokenize
+
+        options, chain = _split(args)
+        if '--regexp' in options or '--unique' in options or environ.get(
+                'ATMARK_REGEXP') != os.environ.get('ATMARK_REGEXP'):
+            return None
+
+        key = tuple(chain)
+        tokens = self.cache.pop(key, None)
+        if tokens is None:
+            tokens = list(_tokenize(list(chain)))
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[key] = tokens
+        return tokens
+
+    def serve(self):
+        from . import commands # noqa, warm up the commands
+
+        if self.path is None:
+            raise SystemExit("atmark: the server needs Unix sockets")
+
+        # The clients connect only to a socket in a private directory
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.mkdir(directory, 0o700)
+        if not is_private(directory):
+            raise SystemExit("atmark: %s must belong to the user and be closed "
+                             "to the others (chmod 700)" % directory)
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(128)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit())
+        sys.stderr.write("Atmark server is listening on %s\n" % self.path)
+
+        try:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    self.accept(conn)
+                except (EOFError, ValueError, EnvironmentError, socket.error):
+                    pass # the client is gone or the request is broken
+                finally:
+                    conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            os.remove(self.path)
+
+    def accept(self, conn):
+        conn.settimeout(REQUEST_TIMEOUT)
+        kind, data = receive(conn)
+        if kind != b'a':
+            return
+        values = decode(data)
+        name, cwd, tty, argc = values[:4]
+        args = values[4:4 + int(argc)]
+        environ = dict(item.split('=', 1) for item in values[4 + int(argc):] if '=' in item)
+        conn.settimeout(None)
+
+        try:
+            tokens = self.tokens(args, environ)
+        except Exception: # noqa, the child reports the error
+            tokens = None
+
+        if os.fork():
+            return
+
+        status = 1
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = self.run(conn, name, cwd, tty, args, environ, tokens)
+        finally:
+            os._exit(status)
+
+    @staticmethod
+    def run(conn, name, cwd, tty, args, environ, tokens):
+        """ Run the request in the child with stdio of the client. """
+        from .atmark import _at, _atat, _cli
+
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        sys.stdin = _text(FrameReader(conn), 'r')
+        sys.stdout = _text(FrameWriter(conn, b'o'), 'w')
+        sys.stderr = _text(FrameWriter(conn, b'e'), 'w')
+        if tty:
+            args = ['--line-buffered'] + args
+
+        status = 0
+        try:
+            _cli(_atat if name == 'atat' else _at, args, tokens)
+        except SystemExit as exc:
+            if isinstance(exc.code, int):
+                status = exc.code
+            elif exc.code is not None:
+                sys.stderr.write("%s\n" % exc.code)
+                status = 1
+        except Exception: # noqa
+            traceback.print_exc()
+            status = 1
+
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            send(conn, b'x', str(status).encode('ascii'))
+        except EnvironmentError:
+            pass
+        return status
+
+
+def serve(path=None):
+    Server(path).serve()
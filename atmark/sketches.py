@@ -0,0 +1,226 @@
+""" Probabilistic counters and sets for huge numbers of distinct lines. """
+import heapq
+import math
+from array import array
+
+
+MASK = (1 << 64) - 1
+
+
+class HyperLogLog(object):
+
+    """ Estimate a number of distinct values with the given relative error. """
+
+    def __init__(self, error=0.01):
+        self.bits = min(max(int(math.ceil(math.log((1.04 / error) ** 2, 2))), 4), 18)
+        self.size = 1 << self.bits
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        value = hash(value) & MASK
+        index = value & (self.size - 1)
+        rank = 64 - self.bits - (value >> self.bits).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def __len__(self):
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+
+class CountMinSketch(object):
+
+    """ Count values with overestimation within `error` of the total count.
+
+    The most frequent values are tracked separately to report them.
+
+    """
+
+    def __init__(self, error=0.01, depth=5):
+        self.width = int(math.ceil(math.e / error))
+        self.depth = depth
+        self.rows = [array('L', [0]) * self.width for _ in range(depth)]
+
+    def add(self, value):
+        value = hash(value) & MASK
+        first, second = value & 0xFFFFFFFF, value >> 32
+        estimate = None
+        for num, row in enumerate(self.rows):
+            index = (first + num * second) % self.width
+            row[index] += 1
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def most_common(self, values, num):
+        """ Count values and return `num` heavy hitters as (value, estimate). """
+        top = dict()
+        floor = 0
+        for value in values:
+            estimate = self.add(value)
+            if value in top or len(top) < num:
+                top[value] = estimate
+            elif estimate > floor:
+                smallest = min(top, key=top.get)
+                if estimate > top[smallest]:
+                    del top[smallest]
+                    top[value] = estimate
+                floor = min(top.values())
+        return heapq.nlargest(num, top.items(), key=lambda item: item[1])
+
+
+def _digests_code():
+    """ Get the type code of the unsigned 64-bit array items ('Q' is missing
+    on Python 2).
+
+    """
+    try:
+        array('Q')
+        return 'Q'
+    except ValueError:
+        return 'L'
+
+
+class Digests(object):
+
+    """ Set of 64-bit digests of the values instead of the values.
+
+    The digests are packed in an array (8 bytes each) with open addressing
+    and linear probing, which is grown twice when it's 2/3 full: 12-24
+    bytes per value. Zero marks a free slot, so the zero digest is stored
+    as 1.
+
+    """
+
+    def __init__(self, size=1 << 10):
+        self.table = array(_digests_code(), [0]) * size
+        self.mask = (1 << 8 * self.table.itemsize) - 1
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, table, digest):
+        """ Get the index of the digest or of the free slot for it. """
+        last = len(table) - 1
+        index = digest & last
+        slot = table[index]
+        while slot and slot != digest:
+            index = (index + 1) & last
+            slot = table[index]
+        return index
+
+    def __contains__(self, value):
+        digest = hash(value) & self.mask or 1
+        return self.table[self._find(self.table, digest)] == digest
+
+    def add(self, value):
+        digest = hash(value) & self.mask or 1
+        table = self.table
+        last = len(table) - 1
+        index = digest & last
+        slot = table[index]
+        while slot:
+            if slot == digest:
+                return
+            index = (index + 1) & last
+            slot = table[index]
+        table[index] = digest
+        self.count += 1
+        if self.count * 3 > len(table) * 2:
+            self.table = array(table.typecode, [0]) * (len(table) * 2)
+            for digest in table:
+                if digest:
+                    self.table[self._find(self.table, digest)] = digest
+
+
+class BloomFilter(object):
+
+    """ Set of 64-bit digests with false positives at the given rate for up
+    to `capacity` digests.
+
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.size = max(int(math.ceil(-capacity * math.log(rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(math.log(2) * self.size / capacity)), 1)
+        self.bits = bytearray((self.size + 7) >> 3)
+        self.count = 0
+
+    def __contains__(self, digest):
+        bits, size = self.bits, self.size
+        index, step = digest & 0xFFFFFFFF, digest >> 32 | 1
+        for _ in range(self.hashes):
+            index %= size
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+            index += step
+        return True
+
+    def add(self, digest):
+        """ Add the digest, return True when it was not found. """
+        bits, size = self.bits, self.size
+        index, step = digest & 0xFFFFFFFF, digest >> 32 | 1
+        new = False
+        for _ in range(self.hashes):
+            index %= size
+            byte, bit = index >> 3, 1 << (index & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                new = True
+            index += step
+        self.count += new
+        return new
+
+
+class ScalableBloomFilter(object):
+
+    """ Set of values with false positives at the given rate, which grows for
+    unbounded streams.
+
+    When the last Bloom filter is full a new one `growth` times larger is
+    added with `ratio` times lower rate, so the total rate stays under `rate`.
+    Its length is the number of the added values which were not found.
+
+    """
+
+    def __init__(self, rate=0.001, capacity=1 << 16, growth=2, ratio=0.5):
+        self.rate = rate
+        self.capacity = capacity
+        self.growth = growth
+        self.ratio = ratio
+        self.filters = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, value):
+        digest = hash(value) & MASK
+        return any(digest in bloom for bloom in self.filters)
+
+    def add(self, value):
+        digest = hash(value) & MASK
+        filters = self.filters
+        for bloom in filters[:-1]:
+            if digest in bloom:
+                return
+
+        bloom = filters and filters[-1]
+        if bloom and bloom.count < bloom.capacity:
+            self.count += bloom.add(digest)
+            return
+        if bloom and digest in bloom:
+            return
+
+        num = len(filters)
+        bloom = BloomFilter(self.capacity * self.growth ** num,
+                            self.rate * (1 - self.ratio) * self.ratio ** num)
+        filters.append(bloom)
+        self.count += bloom.add(digest)
@@ -0,0 +1,184 @@
+""" Per-stage profiling of the commands. """
+import os
+import sys
+import time
+
+from .pipeline import describe
+from .utils import text_type
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Stage(object):
+
+    """ Counters of a command in the chain. """
+
+    __slots__ = 'num', 'name', 'calls', 'passed', 'dropped', 'time', 'bytes_in', 'bytes_out'
+
+    def __init__(self, num, name):
+        self.num = num
+        self.name = name
+        self.calls = self.passed = self.dropped = 0
+        self.time = 0.0
+        self.bytes_in = self.bytes_out = 0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+def _size(value):
+    """ Get a size of the value in bytes (UTF-8). """
+    if isinstance(value, list):
+        return sum(_size(item) for item in value)
+    if isinstance(value, text_type):
+        return len(value.encode('utf-8'))
+    return 0
+
+
+class Stats(object):
+
+    """ Count calls, passed/dropped values, time and bytes of every command.
+
+    Tokens are wrapped by `instrument` only when the stats are requested, so
+    a pipeline without them runs the commands as is.
+
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.lines = 0
+        self.started = self.finished = None
+        self.memo = None
+
+    def instrument(self, tokens):
+        """ Get the tokens with the commands wrapped by counters. """
+        self.started = clock()
+        result = []
+        for num, (func, params) in enumerate(tokens):
+            name = describe(func, params)
+            stage = Stage(num + 1, name)
+            self.stages.append(stage)
+            result.append((self.wrap(func, stage), params))
+        return result
+
+    @staticmethod
+    def wrap(func, stage):
+
+        def wrapper(arg, *params):
+            stage.calls += 1
+            stage.bytes_in += _size(arg.value)
+            start = clock()
+            value = func(arg, *params)
+            stage.time += clock() - start
+            if value is None:
+                stage.dropped += 1
+            else:
+                stage.passed += 1
+                stage.bytes_out += _size(value)
+            return value
+
+        def stream(values, *params):
+            # Only the call is timed: lazy streams are processed later
+            stage.calls += 1
+            start = clock()
+            value = func.stream(values, *params)
+            stage.time += clock() - start
+            if value is None:
+                stage.dropped += 1
+            else:
+                stage.passed += 1
+            return value
+
+        wrapper.__name__ = func.__name__
+        for meta in ('returns', 'refs', 'prepare'):
+            setattr(wrapper, meta, getattr(func, meta, None))
+        wrapper.pure = getattr(func, 'pure', True)
+        wrapper.inline = None
+        wrapper.stream = getattr(func, 'stream', None) and stream
+        return wrapper
+
+    def count(self, stream):
+        """ Count the input lines. """
+        for line in stream:
+            self.lines += 1
+            yield line
+
+    @property
+    def elapsed(self):
+        return (self.finished or clock()) - (self.started or clock())
+
+    def as_dict(self):
+        elapsed = self.elapsed
+        stats = dict(
+            lines=self.lines, time=elapsed,
+            lines_per_sec=self.lines / elapsed if elapsed else 0.0,
+            stages=[stage.as_dict() for stage in self.stages])
+        if self.memo:
+            stats['memo'] = dict(hits=self.memo.hits, misses=self.memo.misses)
+        return stats
+
+    def report(self):
+        """ Format the stats as a table. """
+        rows = ["%3s  %-24s %10s %10s %10s %10s %10s %10s" % (
+            '#', 'stage', 'calls', 'passed', 'dropped', 'time,ms', 'in,KB', 'out,KB')]
+        for stage in self.stages:
+            name = stage.name if len(stage.name) <= 24 else stage.name[:21] + '...'
+            rows.append("%3d  %-24s %10d %10d %10d %10.1f %10.1f %10.1f" % (
+                stage.num, name, stage.calls, stage.passed, stage.dropped,
+                stage.time * 1000, stage.bytes_in / 1024.0, stage.bytes_out / 1024.0))
+        stats = self.as_dict()
+        rows.append("lines: %(lines)d  time: %(time).3fs  lines/sec: %(lines_per_sec).0f" % stats)
+        if self.memo:
+            hits, misses = self.memo.hits, self.memo.misses
+            rows.append("memo: %d hits, %d misses (%.1f%%)" % (
+                hits, misses, 100.0 * hits / ((hits + misses) or 1)))
+        return "\n".join(rows)
+
+    def prometheus(self):
+        """ Format the stats for the textfile collector of Prometheus. """
+        lines = []
+
+        def metric(name, kind, doc, samples):
+            lines.append("# HELP atmark_%s %s" % (name, doc))
+            lines.append("# TYPE atmark_%s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("atmark_%s%s %s" % (name, labels, repr(value)))
+
+        metric('lines_total', 'counter', "Input lines.", [('', self.lines)])
+        metric('seconds', 'gauge', "Processing time.", [('', self.elapsed)])
+        if self.memo:
+            metric('memo_hits_total', 'counter', "Lines found in the cache.",
+                   [('', self.memo.hits)])
+            metric('memo_misses_total', 'counter', "Lines processed by the commands.",
+                   [('', self.memo.misses)])
+        for name, attr, doc in (
+                ('stage_calls_total', 'calls', "Calls of the command."),
+                ('stage_passed_total', 'passed', "Values passed by the command."),
+                ('stage_dropped_total', 'dropped', "Values dropped by the command."),
+                ('stage_seconds_total', 'time', "Time spent in the command."),
+                ('stage_input_bytes_total', 'bytes_in', "Input bytes of the command."),
+                ('stage_output_bytes_total', 'bytes_out', "Output bytes of the command.")):
+            metric(name, 'counter', doc, [(
+                '{stage="%d",command="%s"}' % (stage.num, _escape(stage.name)),
+                getattr(stage, attr)) for stage in self.stages])
+        return "\n".join(lines) + "\n"
+
+    def write(self, table=True, json=False, path=None, stream=None):
+        """ Print the stats (as a table or JSON) and save them to the textfile. """
+        self.finished = clock()
+        stream = stream or sys.stderr
+        if table:
+            stream.write(self.report() + "\n")
+        if json:
+            from json import dumps
+
+            stream.write(dumps(self.as_dict(), sort_keys=True) + "\n")
+        if path:
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.prometheus())
+            os.rename(path + '.tmp', path)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
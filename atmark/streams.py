@@ -0,0 +1,291 @@
+""" Operations over the whole stream for `@@`. """
+import heapq
+import operator
+import sys
+from collections import Counter, OrderedDict, deque
+from itertools import chain, islice
+
+from .utils import escape_errors, parse_size, string_types, text_type
+
+
+# Number of the sorted runs merged at once (every run is an open file)
+FAN_IN = 256
+
+_memory = []
+_approx = []
+_unique = []
+
+UNIQUE_MODES = 'exact', 'hash', 'bloom'
+BLOOM_RATE = 0.001
+
+
+def set_memory(size):
+    """ Set a memory budget for sorting: bytes or a number with K, M or G suffix. """
+    _memory[:] = [parse_size(size)]
+    return _memory[0]
+
+
+def set_approx(error):
+    """ Count `topk` and `distinct` approximately with the given relative error. """
+    _approx[:] = [float(error)]
+    return _approx[0]
+
+
+def set_unique(mode):
+    """ Set how `unique` remembers the keys: exact, hash or bloom[:RATE]. """
+    name, _, rate = mode.partition(':')
+    if name not in UNIQUE_MODES or rate and name != 'bloom':
+        raise ValueError('Unknown mode of unique %r' % mode)
+    _unique[:] = [(name, float(rate) if rate else BLOOM_RATE if name == 'bloom' else None)]
+    return _unique[0]
+
+
+class Seen(object):
+
+    """ Keys seen by `unique`: a set of them, of their 64-bit digests or
+    a Bloom filter (by --unique).
+
+    """
+
+    def __init__(self):
+        self.mode, self.rate = _unique and _unique[0] or ('exact', None)
+        if self.mode == 'exact':
+            self.keys = set()
+        elif self.mode == 'hash':
+            from .sketches import Digests
+
+            self.keys = Digests()
+        else:
+            from .sketches import ScalableBloomFilter
+
+            self.keys = ScalableBloomFilter(self.rate)
+
+    def __str__(self):
+        return self.mode if self.rate is None else "%s:%s" % (self.mode, self.rate)
+
+    def first(self, key):
+        """ Remember the key, return True when it's seen for the first time. """
+        keys = self.keys
+        size = len(keys)
+        keys.add(key)
+        return len(keys) > size
+
+
+def is_stream(value):
+    """ Check the value is a lazy sequence of lines (not a list or a string). """
+    return hasattr(value, '__iter__') and not isinstance(value, (list, dict) + string_types)
+
+
+class Sorted(object):
+
+    """ Sorted stream of lines.
+
+    Lines are sorted in memory unless a memory budget is set by `set_memory`.
+    With the budget, sorted runs are spilled to temporary files and merged.
+
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.memory = _memory and _memory[0]
+
+    def __iter__(self):
+        if not self.memory:
+            return iter(sorted(self.lines))
+        return self.merge()
+
+    def top(self, num):
+        """ Get the first `num` sorted lines keeping only them in memory. """
+        return heapq.nsmallest(num, self.lines)
+
+    def merge(self):
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp(prefix='atmark-sort-')
+        runs = []
+        try:
+            run, size = [], 0
+            for line in self.lines:
+                run.append(line)
+                size += sys.getsizeof(line) + 8
+                if size > self.memory:
+                    run.sort()
+                    runs.append(_spill(run, directory))
+                    run, size = [], 0
+
+            # Too many runs are merged by batches to intermediate runs
+            while len(runs) >= FAN_IN:
+                batch, runs = runs[:FAN_IN], runs[FAN_IN:]
+                runs.append(_spill(heapq.merge(*[_unspill(path) for path in batch]), directory))
+
+            run.sort()
+            for line in heapq.merge(run, *[_unspill(path) for path in runs]):
+                yield line
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def _spill(lines, directory):
+    """ Save lines to a temporary file in the directory, return its path. """
+    import io
+    import tempfile
+
+    fd, path = tempfile.mkstemp(dir=directory)
+    with io.open(fd, 'w', encoding='utf-8', errors=escape_errors, newline='\n') as f:
+        f.writelines(line + '\n' for line in lines)
+    return path
+
+
+def _unspill(path):
+    """ Read lines of a run and remove its file. """
+    import io
+    import os
+
+    with io.open(path, encoding='utf-8', errors=escape_errors, newline='\n') as f:
+        for line in f:
+            yield line[:-1]
+    os.remove(path)
+
+
+def drop(lines, length):
+    length = int(length)
+    if length < 0:
+        return list(lines)[length:]
+    return islice(lines, length, None)
+
+
+def index(lines, num):
+    try:
+        num = int(num)
+    except ValueError:
+        return None
+    if num < 0:
+        lines = deque(lines, -num)
+        return lines[0] if len(lines) == -num else None
+    if isinstance(lines, Sorted):
+        lines = lines.top(num + 1)
+    return next(islice(lines, num, None), None)
+
+
+def last(lines):
+    if isinstance(lines, Sorted):
+        lines = heapq.nlargest(1, lines.lines)
+    lines = deque(lines, 1)
+    return lines[-1] if lines else None
+
+
+def length(lines):
+    return text_type(sum(1 for _ in lines))
+
+
+def nonempty(lines):
+    lines = iter(lines)
+    for first in lines:
+        return chain([first], lines)
+    return None
+
+
+def sort(lines):
+    return Sorted(lines)
+
+
+def tail(lines):
+    return islice(lines, 1, None)
+
+
+def head(lines):
+    if isinstance(lines, Sorted):
+        lines = lines.top(1)
+    return next(iter(lines), None) or None
+
+
+def take(lines, length):
+    length = int(length)
+    if length < 0:
+        return list(lines)[:length]
+    if isinstance(lines, Sorted):
+        return lines.top(length)
+    return islice(lines, length)
+
+
+def _number(line):
+    try:
+        return int(line)
+    except ValueError:
+        try:
+            return float(line)
+        except ValueError:
+            return None
+
+
+def _counts(pairs):
+    return ["%d %s" % (num, value) for value, num in pairs]
+
+
+def count(lines):
+    return _counts(Counter(lines).most_common())
+
+
+def distinct(lines):
+    if _approx:
+        from .sketches import HyperLogLog
+
+        counter = HyperLogLog(_approx[0])
+        for line in lines:
+            counter.add(line)
+        return text_type(len(counter))
+    return text_type(len(set(lines)))
+
+
+def groupby(lines, field):
+    field = int(field)
+    groups = OrderedDict()
+    for line in lines:
+        try:
+            key = line.split(None, field + 1)[field] if field >= 0 else line.split()[field]
+        except IndexError:
+            key = ''
+        groups.setdefault(key, []).append(line)
+    return [line for group in groups.values() for line in group]
+
+
+def _extreme(lines, better):
+    result = best = None
+    for line in lines:
+        num = _number(line)
+        if num is not None and (best is None or better(num, best)):
+            result, best = line, num
+    return result
+
+
+def maximum(lines):
+    return _extreme(lines, operator.gt)
+
+
+def minimum(lines):
+    return _extreme(lines, operator.lt)
+
+
+def topk(lines, num):
+    num = int(num)
+    if _approx:
+        from .sketches import CountMinSketch
+
+        return _counts(CountMinSketch(_approx[0]).most_common(lines, num))
+    return _counts(Counter(lines).most_common(num))
+
+
+def total(lines):
+    result = 0
+    for line in lines:
+        result += _number(line) or 0
+    return text_type(result)
+
+
+def unique(lines):
+    seen = set()
+    for line in lines:
+        if line not in seen:
+            seen.add(line)
+            yield line
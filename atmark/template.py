@@ -0,0 +1,64 @@
+""" Format strings. """
+import re
+
+from .utils import text_type
+
+
+TEMPLATE_RE = re.compile(r'\\([@#\\])|@|#(\d*)')
+
+
+class Template(object):
+
+    """ Format string parsed once to literal pieces and references.
+
+    Symbol '@' is replaced with the current value and '#N' with the N-th
+    history state ('#' is the same as '#0'). '\\@', '\\#' and '\\\\' are
+    the literal symbols.
+
+    """
+
+    __slots__ = 'string', 'pieces', 'refs', 'numbers', 'literals'
+
+    def __init__(self, string):
+        self.string = string
+        self.pieces = []
+        self.refs = []
+
+        literal, pos = '', 0
+        for match in TEMPLATE_RE.finditer(string):
+            literal += string[pos:match.start()]
+            pos = match.end()
+            escaped, num = match.groups()
+            if escaped:
+                literal += escaped
+                continue
+            self.pieces.append(literal)
+            self.refs.append((len(self.pieces), int(num or 0) if num is not None else None))
+            self.pieces.append(None)
+            literal = ''
+        self.pieces.append(literal + string[pos:])
+
+        self.numbers = set(num for _, num in self.refs if num is not None)
+
+        # Templates without history references are joined by the current value
+        self.literals = None
+        if not self.numbers:
+            self.literals = self.pieces[::2]
+
+    def __repr__(self):
+        return "Template(%r)" % self.string
+
+    def render(self, arg):
+        if self.literals is not None:
+            return text_type(arg).join(self.literals)
+
+        pieces = list(self.pieces)
+        value = None
+        for pos, num in self.refs:
+            if num is None:
+                if value is None:
+                    value = text_type(arg)
+                pieces[pos] = value
+            else:
+                pieces[pos] = text_type(arg.history.get(num, ""))
+        return "".join(pieces)
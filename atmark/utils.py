@@ -1,12 +1,26 @@
 import codecs
+import mmap
+import os
+import stat
 import sys
-from re import compile as re
 
 
-ANSI = lambda: None
-ANSI.colors = 'black', 'red', 'green', 'yellow', 'blue', 'magenta', 'cyan', 'white', 'reset'
-ANSI.reset = '\033[0m'
-ANSI.re = re(r'\033\[((?:\d|;)*)([a-zA-Z])')
+class _ANSI(object):
+
+    colors = 'black', 'red', 'green', 'yellow', 'blue', 'magenta', 'cyan', 'white', 'reset'
+    reset = '\033[0m'
+
+    def __getattr__(self, name):
+        """ Compile the regexp on the first use: importing `re` is slow. """
+        if name != 're':
+            raise AttributeError(name)
+        from re import compile as re
+
+        self.re = re(r'\033\[((?:\d|;)*)([a-zA-Z])')
+        return self.re
+
+ANSI = _ANSI()
+BLOCK_SIZE = 1 << 20
 PY2 = sys.version_info[0] == 2
 
 
@@ -22,6 +36,7 @@ if PY2:
 
     text_type = unicode
     string_types = (str, unicode)
+    escape_errors = 'strict'
     is_bytes = lambda x: isinstance(x, (buffer, bytearray))
 
 else:
@@ -29,15 +44,27 @@ else:
 
     text_type = str
     string_types = (str,)
+    escape_errors = 'surrogateescape'
     is_bytes = lambda x: isinstance(x, (bytes, bytearray))
 
 
-def get_stream(stream=sys.stdin):
+def get_stream(stream=sys.stdin, encoding=None, block_size=BLOCK_SIZE):
 
     if isatty(stream):
         stream = StringIO()
 
-    encoding = getattr(stream, 'encoding', None) or sys.getdefaultencoding()
+    # Text streams with an underlying binary buffer are read by large blocks
+    # (and decompressed when they start with the magic bytes of gzip, xz...)
+    buffer = getattr(stream, 'buffer', None)
+    if buffer is not None:
+        from .inputs import uncompressed
+
+        encoding = encoding or stream.encoding
+        errors = getattr(stream, 'errors', None) or 'strict'
+        blocks = uncompressed(read_blocks(stream, block_size))
+        return iter_lines(blocks, encoding, errors)
+
+    encoding = encoding or getattr(stream, 'encoding', None) or sys.getdefaultencoding()
     if codecs.lookup(encoding).name == 'ascii':
         encoding = 'utf-8'
     codecs.getwriter(encoding)(sys.stdout)
@@ -54,6 +81,111 @@ def get_stream(stream=sys.stdin):
     return gen()
 
 
+def _mmap(stream):
+    """ Map a regular file into memory. Return None for pipes and sockets. """
+    try:
+        fileno = stream.fileno()
+        info = os.fstat(fileno)
+        if not stat.S_ISREG(info.st_mode) or not info.st_size:
+            return None
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+
+
+def read_blocks(stream, size=BLOCK_SIZE):
+    """ Iterate over the binary stream by blocks of the given size. """
+    binary = getattr(stream, 'buffer', stream)
+    mapped = _mmap(binary)
+    if mapped is not None:
+        offset = binary.tell()
+        binary.seek(0, os.SEEK_END)
+        for offset in range(offset, len(mapped), size):
+            yield mapped[offset:offset + size]
+        mapped.close()
+        return
+
+    # Pipes and terminals give the bytes written so far, so the lines are
+    # processed as soon as they come (`tail -f log | @ ...`)
+    read = getattr(binary, 'read1', None)
+    if read is None:
+        try:
+            fileno = binary.fileno()
+            read = lambda size: os.read(fileno, size)
+        except (AttributeError, EnvironmentError, ValueError):
+            read = binary.read
+
+    while True:
+        block = read(size)
+        if not block:
+            break
+        yield block
+
+
+def iter_lines(blocks, encoding, errors='strict'):
+    """ Decode binary blocks and split them to lines.
+
+    Lines are separated by '\\n' only and stripped from '\\r' as well as
+    `readline` based stream does.
+
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    tail = ''
+    for block in blocks:
+        state = decoder.getstate()
+        try:
+            text = tail + decoder.decode(block)
+        except UnicodeDecodeError:
+            # Emit the lines before the broken one and fail on it
+            decoder.setstate(state)
+            parts = block.split(b'\n')
+            for part in parts[:-1]:
+                yield (tail + decoder.decode(part + b'\n')).strip('\n\r')
+                tail = ''
+            decoder.decode(parts[-1])
+            raise
+
+        lines = text.split('\n')
+        tail = lines.pop()
+        if '\r' in text:
+            lines = [line.strip('\r') for line in lines]
+        for line in lines:
+            yield line
+
+    tail += decoder.decode(b'', True)
+    if tail:
+        for line in tail.split('\n'):
+            yield line.strip('\r')
+
+SIZE_UNITS = dict(K=1 << 10, M=1 << 20, G=1 << 30)
+
+
+def parse_size(size):
+    """ Parse a size in bytes: a number with optional K, M or G suffix. """
+    size = size.strip().upper().rstrip('B')
+    unit = SIZE_UNITS.get(size[-1:], 1)
+    return int(float(size.rstrip('KMG')) * unit)
+
+
+REGEXP_ENGINES = 're', 'regex', 're2'
+_regexp_engine = []
+
+
+def set_regexp_engine(name):
+    """ Select a module to compile regexps with: re, regex or re2. """
+    if name not in REGEXP_ENGINES:
+        raise ValueError('Unknown regexp engine %r' % name)
+    _regexp_engine[:] = [__import__(name)]
+    return name
+
+
+def regexp(pattern):
+    """ Compile the pattern with the selected engine ($ATMARK_REGEXP or re). """
+    if not _regexp_engine:
+        set_regexp_engine(os.environ.get('ATMARK_REGEXP') or 're')
+    return _regexp_engine[0].compile(pattern)
+
+
 def style(text, fg=None, bg=None, bold=None, dim=None, underline=None,
           blink=None, reverse=None, reset=True):
     bits = []
@@ -89,7 +221,7 @@ def echo(message, nl=True):
     if not isinstance(message, string_types):
         message = text_type(message)
 
-    if not isatty(stream):
+    if not isatty(stream) and '\033' in message:
         message = ANSI.re.sub('', message)
 
     if message:
@@ -100,6 +232,25 @@ def echo(message, nl=True):
 
     stream.flush()
 
-unicode_escape = lambda s: codecs.getdecoder('unicode_escape')(s)[0]
+# Escape sequences of Python strings
+ESCAPE_RE = (r'\\(?:[\\\'"abfnrtv\n]|[0-7]{1,3}|x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|'
+             r'U[0-9a-fA-F]{8}|N\{[^}]+\})')
+_escapes = []
+
+
+def unicode_escape(string):
+    """ Decode the escape sequences of the string ('\\t', '\\x41'), keep the
+    others ('\\@', '\\d') and the non-ASCII characters as they are.
+
+    """
+    if PY2:
+        return codecs.getdecoder('unicode_escape')(string)[0]
+    if '\\' not in string:
+        return string
+    if not _escapes:
+        from re import compile as re
+
+        _escapes.append(re(ESCAPE_RE))
+    return _escapes[0].sub(lambda match: codecs.decode(match.group(), 'unicode_escape'), string)
 
 # pylama:ignore=E731
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+""" Deterministic corpora for the benchmarks.
+
+Every generator yields `num` lines made by a random generator with the given
+seed, so the same arguments give the same lines on every run (of the same
+major version of Python).
+
+"""
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import random
+
+
+SEED = 42
+
+USERS = 'root', 'www-data', 'postgres', 'nobody', 'alice', 'bob', 'mysql', 'redis'
+COMMANDS = (
+    '/usr/lib/systemd/systemd --switched-root --system --deserialize 31',
+    '/usr/sbin/sshd -D', 'nginx: worker process', 'postgres: checkpointer',
+    '/usr/bin/python3 -m http.server 8000', '/sbin/sysmond', 'bash', '[kworker/0:1-events]',
+)
+PATHS = (
+    '/', '/index.html', '/api/v1/users', '/api/v1/orders', '/static/app.js',
+    '/static/style.css', '/login', '/favicon.ico', '/images/logo.png',
+)
+METHODS = 'GET', 'GET', 'GET', 'POST', 'PUT', 'DELETE'
+STATUSES = 200, 200, 200, 200, 301, 304, 404, 500
+AGENTS = (
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)',
+    'curl/7.68.0', 'Googlebot/2.1 (+http://www.google.com/bot.html)',
+)
+WORDS = (
+    'hello', 'world', 'atmark', 'пример', 'строка', 'данные', 'größe', 'straße',
+    'café', 'naïve', '日本語', 'テキスト', '中文', 'ελληνικά', 'עברית', 'العربية', '😀',
+)
+EXTENSIONS = 'html', 'txt', 'jpg', 'png', 'tar.gz', 'py', 'log'
+
+
+def access_log(num, seed=SEED):
+    """ Lines of nginx access log (combined format). """
+    rand = random.Random(seed)
+    for second in range(num):
+        yield ('%d.%d.%d.%d - - [10/Oct/2024:%02d:%02d:%02d +0000] '
+               '"%s %s HTTP/1.1" %d %d "-" "%s"') % (
+            rand.randint(1, 254), rand.randint(0, 255), rand.randint(0, 255),
+            rand.randint(1, 254), second // 3600 % 24, second // 60 % 60, second % 60,
+            rand.choice(METHODS), rand.choice(PATHS), rand.choice(STATUSES),
+            rand.randint(0, 50000), rand.choice(AGENTS))
+
+
+def ps_aux(num, seed=SEED):
+    """ Lines of `ps aux` table (with the header). """
+    rand = random.Random(seed)
+    yield 'USER       PID %CPU %MEM    VSZ   RSS TTY      STAT START   TIME COMMAND'
+    for pid in range(1, num):
+        yield '%-8s %5d %4.1f %4.1f %6d %5d %-8s %-4s %5s %6s %s' % (
+            rand.choice(USERS), pid, rand.random() * 10, rand.random() * 5,
+            rand.randint(1000, 999999), rand.randint(100, 99999), rand.choice(('?', 'pts/0')),
+            rand.choice(('Ss', 'S', 'R', 'Sl', 'I<')), 'Oct10',
+            '%d:%02d' % (rand.randint(0, 99), rand.randint(0, 59)), rand.choice(COMMANDS))
+
+
+def filenames(num, seed=SEED):
+    """ Names of files as `ls` lists them. """
+    rand = random.Random(seed)
+    for _ in range(num):
+        yield '%s-%s_%d.%s' % (
+            rand.choice(WORDS[:3]), rand.choice(('report', 'photo', 'backup', 'draft')),
+            rand.randint(0, 9999), rand.choice(EXTENSIONS))
+
+
+def unicode_text(num, seed=SEED):
+    """ Lines of words of mixed scripts (cyrillic, CJK, greek, emoji). """
+    rand = random.Random(seed)
+    for _ in range(num):
+        yield ' '.join(rand.choice(WORDS) for _ in range(rand.randint(5, 15)))
+
+
+def json_log(num, seed=SEED):
+    """ Lines of access log as JSON records (`--json`). """
+    rand = random.Random(seed)
+    for second in range(num):
+        time = '2024-10-10T%02d:%02d:%02d' % (second // 3600 % 24, second // 60 % 60, second % 60)
+        yield json.dumps(dict(
+            time=time, status=rand.choice(STATUSES), request=dict(
+                method=rand.choice(METHODS), path=rand.choice(PATHS), agent=rand.choice(AGENTS))),
+            sort_keys=True)
+
+
+def urls(num, seed=SEED):
+    """ Requested URLs: a thousand of distinct ones repeated (for `--memo`). """
+    rand = random.Random(seed)
+    distinct = ['%s?id=%d' % (rand.choice(PATHS), n) for n in range(1000)]
+    for _ in range(num):
+        yield rand.choice(distinct)
+
+
+CORPORA = dict(
+    access_log=access_log, ps_aux=ps_aux, filenames=filenames, unicode_text=unicode_text,
+    json_log=json_log, urls=urls)
+
+
+def write(name, num, directory, seed=SEED):
+    """ Write the corpus to a file in the directory once, return its path. """
+    path = os.path.join(directory, '%s-%d-%d.txt' % (name, num, seed))
+    if not os.path.exists(path):
+        with io.open(path + '.tmp', 'w', encoding='utf-8', newline='\n') as stream:
+            for line in CORPORA[name](num, seed):
+                stream.write(line + '\n')
+        os.rename(path + '.tmp', path)
+    return path
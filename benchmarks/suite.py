@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Time the README pipelines end to end, every command and option on its own.
+
+    $ python benchmarks/suite.py [--lines N] [--repeat N] [--only TEXT]
+                                 [--json PATH] [--compare PATH] [--threshold 0.15]
+
+The corpora (access log, `ps aux` table, file names, unicode text, JSON
+records and repeated URLs) are generated by `corpora` with a fixed seed.
+End to end runs pipe a corpus to `@` in a new process; the awk/sed baselines
+run on the same input when they are installed. Per command runs process the
+lines of a corpus in this process by the compiled pipeline, by `Arg.process`
+and (for the split commands) without the fused field commands. Option runs
+time the chains with `--batch`, `--memo`, `--jobs`, the JSON parsers and the
+regexp engines. Reading (`get_stream`, `--file`), writing (`Output`, `echo`,
+`--out-by`) and the processes (`--exec`, `--server`, the startup and the
+bash completion) are timed as well.
+
+Every result is the best throughput (lines/sec, runs/sec of the processes)
+of `--repeat` runs. With `--json` the results are saved; with `--compare`
+they are compared with the saved ones and the suite fails when any of them
+is slower by more than `--threshold` (0.15 is 15%, the best of a few runs
+still varies by several percent on a busy machine). The suite fails as well
+when the startup of `@` is over its budget.
+
+"""
+import argparse
+import gc
+import gzip
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import closing
+from time import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import corpora # noqa
+from atmark import records # noqa
+from atmark.atmark import _at, _tokenize # noqa
+from atmark.inputs import read_files # noqa
+from atmark.output import Output, PartitionedOutput # noqa
+from atmark.pipeline import history_refs, optimize, processor # noqa
+from atmark.template import Template # noqa
+from atmark.utils import REGEXP_ENGINES, echo, get_stream, set_regexp_engine # noqa
+
+
+AT = "from atmark.client import at; at()"
+
+# The README examples: name, corpus, commands of `@`, the awk/sed baseline
+PIPELINES = (
+    ('rename', 'filenames', ['sub', '-', '_', 'mv # @.jpg'],
+     ['awk', '{l = $0; gsub(/-/, "_"); print "mv " l " " $0 ".jpg"}']),
+    ('extension', 'filenames', ['split', '.', 'head', 'mv # @.php'],
+     ['awk', '-F.', '{print "mv " $0 " " $1 ".php"}']),
+    ('drop columns', 'ps_aux', ['split_', 'drop', '3', 'join', '\\t'],
+     ['awk', '{for(i=1;i<4;i++) $i="";print}']),
+    ('second column', 'ps_aux', ['field_', '1'], ['awk', '{print $2}']),
+    ('kill', 'ps_aux', ['grep', 'sysmond$', 'field_', '1', 'kill @'],
+     ['awk', '/sysmond$/ {print "kill " $2}']),
+    ('first by ip', 'access_log', ['field_', '0', 'unique', '@', '#'], ['awk', '!seen[$1]++']),
+    ('not found', 'access_log', ['grep', ' 404 ', 'field_', '6'], ['awk', '$9 == 404 {print $7}']),
+    ('upper', 'unicode_text', ['upper'], ['awk', '{print toupper($0)}']),
+    ('replace', 'unicode_text', ['replace', 'café', 'cafe'], ['sed', 's/café/cafe/g']),
+)
+
+COMMANDS = (
+    ('filenames', ['replace', '-', '_']),
+    ('filenames', ['split', '.']),
+    ('filenames', ['split', '.', 'head']),
+    ('filenames', ['format', 'mv # @.jpg']),
+    ('filenames', ['@.bak']),
+    ('filenames', ['split', '.', 'head', 'replace', '-', '_', 'mv # @.jpg']),
+    ('filenames', ['upper']),
+    ('filenames', ['capitalize']),
+    ('filenames', ['strip', '.txt']),
+    ('filenames', ['length']),
+    ('filenames', ['reverse']),
+    ('filenames', ['kill', '[0-9]']),
+    ('filenames', ['grep', 'photo']),
+    ('filenames', ['notgrep', 'photo']),
+    ('filenames', ['==', 'bash']),
+    ('ps_aux', ['split_']),
+    ('ps_aux', ['field_', '1']),
+    ('ps_aux', ['fields_', '1-3', 'join', ':']),
+    ('ps_aux', ['split_', 'drop', '3', 'join', '\\t']),
+    ('ps_aux', ['nocolor']),
+    ('access_log', ['field', '"', '1']),
+    ('access_log', ['unique_']),
+    ('unicode_text', ['lower']),
+    ('unicode_text', ['split_', 'last']),
+    ('unicode_text', ['replace', 'café', 'cafe']),
+)
+
+# The split commands are timed without the fused field commands as well
+UNFUSED = (
+    ('ps_aux', ['split_', 'index', '1']),
+    ('ps_aux', ['split_', 'head']),
+    ('ps_aux', ['split', ' ', 'take', '2', 'join', ':']),
+    ('unicode_text', ['split_', 'last']),
+)
+
+JOBS_CHAIN = ['grep', r'(\d+\.){3}\d+.*"GET [^"]*(png|css|js)', 'kill', r'\s+\d+$',
+              'split_', 'map', 'upper', 'join', ' ']
+
+# The chains by `_at` with the options of `@`: corpus, commands, options
+OPTION_RUNS = (
+    ('filenames', ['upper'], dict(batch=4096)),
+    ('filenames', ['grep', 'photo', 'replace', '-', '_', 'strip', '.txt', 'lower'],
+     dict(batch=4096)),
+    ('filenames', ['filter', 'length'], dict(batch=4096)),
+    ('filenames', ['!=', 'x', '@.bak'], dict(batch=4096)),
+    ('urls', ['upper'], dict(memo=1000)),
+    ('urls', ['split', '?', 'head', 'replace', '-', '_', 'kill', r'\d+', 'strip', '/', 'lower'],
+     dict(memo=1000)),
+    ('access_log', JOBS_CHAIN, dict(jobs=1)),
+    ('access_log', JOBS_CHAIN, dict(jobs=2)),
+    ('access_log', JOBS_CHAIN, dict(jobs=4)),
+)
+
+RECORDS_PARSERS = 'orjson', 'ujson', 'json'
+RECORDS_CHAINS = ['get', 'request.path'], ['grep', '"status": 5', 'get', 'request.path']
+
+# `notgrep P1 notgrep P2 ...` of the patterns which never match
+REGEXP_PATTERNS = 100
+
+# Invocations of `@` in a run of the process benchmarks
+PROCESS_RUNS = 20
+
+# The fan-out of `--out-by`: files, max open
+PARTITIONS = (10, 256), (1000, 256), (1000, 16)
+
+# The median startup over a bare interpreter, seconds
+STARTUP_BUDGET = dict(run=0.05, complete=0.03)
+
+
+class Null(object):
+
+    """ Stream which drops the written data. """
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def which(name):
+    try:
+        return shutil.which(name)
+    except AttributeError:
+        from distutils.spawn import find_executable
+
+        return find_executable(name)
+
+
+def best(func, repeat, setup=None):
+    """ Get the shortest time of the runs, `setup` gets the arguments of
+    every run out of the time. The garbage collector is off while a run is
+    timed (as in `timeit`).
+
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time()
+            func(*args)
+            times.append(time() - start)
+        finally:
+            gc.enable()
+    return min(times)
+
+
+def run(args, path):
+    env = dict(os.environ, PYTHONPATH=ROOT, ATMARK_SOCKET=os.devnull + '.sock')
+    with open(path, 'rb') as stdin, open(os.devnull, 'wb') as stdout:
+        subprocess.check_call(args, stdin=stdin, stdout=stdout, env=env)
+
+
+def end_to_end(files, lines, repeat, only):
+    results, baselines = dict(), dict()
+    for name, corpus, chain, baseline in PIPELINES:
+        name = 'e2e: %s' % name
+        if only and only not in name:
+            continue
+        path = files[corpus]
+        elapsed = best(lambda: run([sys.executable, '-c', AT] + chain, path), repeat)
+        results[name] = lines / elapsed
+        if which(baseline[0]):
+            baselines[name] = lines / best(lambda: run(baseline, path), repeat)
+        report(name, results[name], baselines.get(name))
+    return results, baselines
+
+
+def per_command(lines, repeat, only):
+    results = dict()
+    data = dict((name, list(corpora.CORPORA[name](lines))) for name in set(
+        corpus for corpus, _ in COMMANDS + UNFUSED))
+    runs = [(corpus, chain, True, True, '') for corpus, chain in COMMANDS]
+    runs += [(corpus, chain, False, True, ' (Arg.process)') for corpus, chain in COMMANDS]
+    runs += [(corpus, chain, True, False, ' (not fused)') for corpus, chain in UNFUSED]
+    for corpus, chain, compiled, fused, suffix in runs:
+        name = '%s: %s%s' % (corpus, " ".join(chain), suffix)
+        if only and only not in name:
+            continue
+
+        # A new processor for every run: `unique` remembers the lines
+        def setup():
+            tokens = list(_tokenize(list(chain)))
+            keep = history_refs(tokens)
+            if fused:
+                tokens = optimize(tokens, keep)
+            return processor(tokens, keep, compiled), data[corpus]
+
+        def bench(process, lines):
+            for line in lines:
+                process(line)
+
+        results[name] = lines / best(bench, repeat, setup)
+        report(name, results[name])
+    return results
+
+
+def consume(chain, data, **options):
+    for _ in _at(list(chain), iter(data), **options):
+        pass
+
+
+def option_bench(lines, repeat, only):
+    """ Time the chains by `_at` with the options, the JSON parsers and the
+    regexp engines.
+
+    """
+    results = dict()
+    data = dict((name, list(corpora.CORPORA[name](lines))) for name in set(
+        corpus for corpus, _, _ in OPTION_RUNS) | set(['json_log']))
+
+    def measure(name, *args, **options):
+        if not only or only in name:
+            results[name] = lines / best(lambda: consume(*args, **options), repeat)
+            report(name, results[name])
+
+    for corpus, chain, options in OPTION_RUNS:
+        flags = " ".join('--%s %s' % item for item in sorted(options.items()))
+        measure('%s: %s %s' % (corpus, flags, " ".join(chain)), chain, data[corpus], **options)
+
+    loads = records._loads[:]
+    try:
+        for parser in RECORDS_PARSERS:
+            try:
+                records._loads[:] = [__import__(parser).loads]
+            except ImportError:
+                continue
+            for chain in RECORDS_CHAINS:
+                measure('json_log: %s (%s)' % (" ".join(chain), parser), chain, data['json_log'])
+    finally:
+        records._loads[:] = loads
+
+    chain = []
+    for num in range(REGEXP_PATTERNS):
+        chain += ['notgrep', r'user=%d\b' % num]
+    for engine in REGEXP_ENGINES:
+        try:
+            set_regexp_engine(engine)
+        except ImportError:
+            continue
+        measure('access_log: notgrep x%d (%s)' % (REGEXP_PATTERNS, engine),
+                chain, data['access_log'])
+    set_regexp_engine('re')
+    return results
+
+
+def io_bench(files, lines, repeat, only):
+    results = dict()
+    path = files['access_log']
+    data = list(corpora.access_log(lines))
+
+    def read():
+        with open(path) as stream:
+            for _ in get_stream(stream):
+                pass
+
+    def write():
+        output = Output(Null(), line_buffered=False)
+        for line in data:
+            output.write(line)
+        output.close()
+
+    def print_():
+        stdout, sys.stdout = sys.stdout, Null()
+        try:
+            for line in data:
+                echo(line)
+        finally:
+            sys.stdout = stdout
+
+    def read_pipe():
+        # A stream without a file descriptor is read by blocks instead of mmap
+        with open(path, 'rb') as stream:
+            buffered = io.BufferedReader(io.BytesIO(stream.read()))
+        for _ in get_stream(io.TextIOWrapper(buffered, encoding='utf-8')):
+            pass
+
+    compressed = path + '.gz'
+    with open(path, 'rb') as stream, closing(gzip.open(compressed, 'wb')) as archive:
+        shutil.copyfileobj(stream, archive)
+
+    def read_paths(paths):
+        for _ in read_files(paths):
+            pass
+
+    benches = [
+        ('get_stream', read), ('get_stream (blocks)', read_pipe),
+        ('--file', lambda: read_paths([path])),
+        ('--file (gzip)', lambda: read_paths([compressed])),
+        ('Output', write), ('echo', print_)]
+
+    for files_, max_open in PARTITIONS:
+        partitioned = ['host-%d %s' % (num % files_, line) for num, line in enumerate(data)]
+
+        def partition(lines=partitioned, max_open=max_open):
+            root = tempfile.mkdtemp(prefix='atmark-bench-')
+            try:
+                template = Template(os.path.join(root, '#2.log'))
+                output = PartitionedOutput(template, max_open=max_open)
+                for arg in _at(['split_', 'head', '#0'], iter(lines), out_by=template):
+                    output.write(arg)
+                output.close()
+            finally:
+                shutil.rmtree(root)
+
+        benches.append(('--out-by %d files (max open %d)' % (files_, max_open), partition))
+
+    for name, func in benches:
+        name = 'io: %s' % name
+        if only and only not in name:
+            continue
+        results[name] = lines / best(func, repeat)
+        report(name, results[name])
+    return results
+
+
+def process_bench(repeat, only):
+    """ Time the runs of `@` by new processes: `--exec`, `--server`, the
+    startup and the bash completion. Return the results and the names of
+    the startups over the budget.
+
+    """
+    results, failed = dict(), []
+    directory = tempfile.mkdtemp(prefix='atmark-bench-')
+    env = dict(os.environ, PYTHONPATH=ROOT, ATMARK_SOCKET=os.path.join(directory, 'atmark.sock'))
+    at = [sys.executable, '-c', AT]
+    commands = "".join("file-%d\n" % num for num in range(PROCESS_RUNS * 10)).encode('utf-8')
+
+    def call(args, data=b'some-file.txt\n', env=env, **kwargs):
+        proc = subprocess.Popen(args, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                **kwargs)
+        proc.communicate(data)
+
+    def runs(args):
+        for _ in range(PROCESS_RUNS):
+            call(args)
+
+    def measure(name, func, count=PROCESS_RUNS, unit='runs/sec'):
+        if not only or only in name:
+            results[name] = count / best(func, repeat)
+            report(name, results[name], unit=unit)
+
+    try:
+        chain = ['/bin/true @']
+        measure('exec: | sh', lambda: call(" ".join(
+            quote(arg) for arg in at + chain) + " | sh", commands, shell=True),
+            len(commands.split()), 'commands/sec')
+        for jobs, size in ((1, 1), (4, 1), (1, 100), (4, 100)):
+            args = at + ['--exec', '-P', str(jobs), '-n', str(size)] + chain
+            measure('exec: --exec -P %d -n %d' % (jobs, size), lambda: call(args, commands),
+                    len(commands.split()), 'commands/sec')
+
+        chain = at + ['split', '.', 'head', 'upper', '@.BAK']
+        measure('server: in-process', lambda: runs(chain))
+        if not only or only in 'server: --server':
+            server = subprocess.Popen(at + ['--server'], env=env, stderr=subprocess.PIPE)
+            try:
+                server.stderr.readline()
+                measure('server: --server', lambda: runs(chain))
+            finally:
+                server.terminate()
+                server.wait()
+
+        # The startup is the median overhead over a bare interpreter
+        complete = dict(env, COMP_WORDS="@ up", COMP_CWORD="1", _ATMARK_COMPLETE="complete")
+        startups = [(kind, args, env_) for kind, args, env_ in (
+            ('run', at + ['upper'], env), ('complete', at, complete))
+            if not only or only in 'startup: %s' % kind]
+        bare = startups and median(lambda: call([sys.executable, '-c', 'pass']), repeat * 4)
+        for kind, args, env_ in startups:
+            elapsed = median(lambda: call(args, env=env_), repeat * 4)
+            results['startup: %s' % kind] = 1 / elapsed
+            if elapsed - bare > STARTUP_BUDGET[kind]:
+                failed.append(kind)
+            report('startup: %s' % kind, 1 / elapsed, unit=(
+                'runs/sec (+%.1f ms, budget %.0f ms) %s' % (
+                    (elapsed - bare) * 1000, STARTUP_BUDGET[kind] * 1000,
+                    'FAIL' if kind in failed else 'ok')))
+    finally:
+        shutil.rmtree(directory)
+    return results, failed
+
+
+def median(func, runs):
+    times = []
+    for _ in range(runs):
+        start = time()
+        func()
+        times.append(time() - start)
+    return sorted(times)[runs // 2]
+
+
+def report(name, result, baseline=None, unit='lines/sec'):
+    message = "%-50s %12.0f %s" % (name, result, unit)
+    if baseline:
+        message += "  (baseline %.0f, x%.2f)" % (baseline, result / baseline)
+    sys.stderr.write(message + "\n")
+
+
+def compare(results, saved, threshold):
+    """ Print the changes of the throughput, return True when any of them
+    is a regression over the threshold.
+
+    """
+    failed = False
+    for name in sorted(set(results) & set(saved)):
+        change = results[name] / saved[name] - 1
+        regression = change < -threshold
+        failed = failed or regression
+        sys.stderr.write("%-50s %+7.1f%% %s\n" % (
+            name, change * 100, regression and 'REGRESSION' or ''))
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Atmark benchmark suite")
+    parser.add_argument('--lines', type=int, default=100000, help="lines of every corpus")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of every benchmark")
+    parser.add_argument('--only', help="run the benchmarks which names contain the text")
+    parser.add_argument('--json', help="save the results to the file")
+    parser.add_argument('--compare', help="compare the results with the saved ones")
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help="fail when the throughput drops more (0.15 is 15%%)")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='atmark-bench-')
+    try:
+        files = dict((name, corpora.write(name, args.lines, directory))
+                     for name in corpora.CORPORA)
+        results, baselines = end_to_end(files, args.lines, args.repeat, args.only)
+        results.update(per_command(args.lines, args.repeat, args.only))
+        results.update(option_bench(args.lines, args.repeat, args.only))
+        results.update(io_bench(files, args.lines, args.repeat, args.only))
+        processes, over_budget = process_bench(args.repeat, args.only)
+        results.update(processes)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.json:
+        with open(args.json, 'w') as stream:
+            json.dump(dict(
+                python=platform.python_version(), lines=args.lines, seed=corpora.SEED,
+                results=results, baselines=baselines), stream, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as stream:
+            saved = json.load(stream)
+        if saved.get('lines') != args.lines:
+            sys.stderr.write("The results are saved for %s lines\n" % saved.get('lines'))
+        return compare(results, saved['results'], args.threshold) or bool(over_budget)
+    return bool(over_budget)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
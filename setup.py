@@ -63,8 +63,8 @@ setup(
 
     entry_points={
         'console_scripts': [
-            '@ = atmark.atmark:at',
-            '@@ = atmark.atmark:atat',
+            '@ = atmark.client:at',
+            '@@ = atmark.client:atat',
         ],
     },
 
@@ -50,6 +50,17 @@ def test_cli():
     with pytest.raises(SystemExit):
         _cli(_, [])
 
+    # Invalid options exit with a message instead of a traceback
+    from atmark.atmark import _options
+    for args, message in (
+            (['-j', 'abc', 'upper'], "atmark: -j abc: "),
+            (['--regexp', 'nosuchengine'], "atmark: --regexp nosuchengine: "),
+            (['--unique', 'x'], "atmark: --unique x: "),
+            (['--jobs'], "atmark: --jobs needs a value")):
+        with pytest.raises(SystemExit) as info:
+            _options(args)
+        assert str(info.value.code).startswith(message)
+
 
 def test_errors():
     result = _at("test.py some-file", "replace", "-")
@@ -282,6 +293,13 @@ def test_last():
     result = _at("test.py some-file", "split", ".", "last")
     assert ["py", "some-file"] == result
 
+    # A blank line is dropped by the fused `field_ -1` and without the fusion
+    from atmark.atmark import _at as at
+    for options in ({}, {'debug': True}):
+        assert list(map(str, at(['split_', 'last'], iter(['a b', '', 'c']), **options))) == [
+            'b', 'c']
+    assert _atat("", "last") == [None]
+
 
 def test_sort():
     result = _at("test.py some-file", "sort")
@@ -293,12 +311,808 @@ def test_reverse():
     assert ["yp.tset", "elif-emos"] == result
 
 
-def _at(data, *chain):
+def test_output():
+    from atmark.output import Output
+    from atmark.utils import StringIO, style
+
+    stream = StringIO()
+    output = Output(stream)
+    output.write(style("red", fg='red'))
+    output.write(42)
+    assert stream.getvalue() == ''
+
+    output.flush()
+    assert stream.getvalue() == 'red\n42\n'
+
+    stream = StringIO()
+    output = Output(stream, line_buffered=True)
+    output.write("line")
+    assert stream.getvalue() == 'line\n'
+
+    # The results before an error are printed
+    import subprocess
+    import sys
+
+    proc = subprocess.Popen(
+        [sys.executable, '-c', 'from atmark.atmark import at; at()', 'cap'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(b"a\nb\n\nc\n")
+    assert out == b"A\nB\n" and b"Error" in err
+
+
+def test_partitioned_output(tmpdir):
+    from atmark.atmark import _at as _
+    from atmark.output import OutputError, PartitionedOutput
+    from atmark.template import Template
+
+    template = Template(str(tmpdir.join('#1', '@.log')))
+    output = PartitionedOutput(template, max_open=2, size=10)
+    for arg in _(['take', '1', '#0'], iter("a1 b1 c1 a2 b2 a3".split()), debug=True):
+        output.write(arg)
+    assert len(output.handles) == 2
+    assert not tmpdir.join('a', 'a1.log').check()
+
+    output.close()
+    assert tmpdir.join('a', 'a1.log').read() == 'a1\n'
+    assert tmpdir.join('b', 'b2.log').read() == 'b2\n'
+    assert not tmpdir.join('a').listdir('.atmark-*')
+
+    output = PartitionedOutput(Template(str(tmpdir.join('@'))), max_open=1, size=0)
+    for value in "x y x".split():
+        output.write(value)
+    assert len(tmpdir.listdir('.atmark-*')) == 2
+    output.close(False)
+    assert not tmpdir.listdir('.atmark-*') and not tmpdir.join('x').check()
+
+    # A path doesn't collide with the temporary file of another one
+    output = PartitionedOutput(Template(str(tmpdir.join('parts', '#'))))
+    for value in "a.tmp a".split():
+        output.write(value)
+    output.close()
+    assert tmpdir.join('parts', 'a.tmp').read() == 'a.tmp\n'
+    assert tmpdir.join('parts', 'a').read() == 'a\n'
+
+    output = PartitionedOutput(Template(str(tmpdir.join('dirs', '@'))))
+    output.write('b')
+    with pytest.raises(OutputError):
+        output.write('')
+    output.close(False)
+    assert not tmpdir.join('dirs').check()
+
+    # Every file is renamed, the failed ones are reported
+    output = PartitionedOutput(Template(str(tmpdir.join('fail', '@'))))
+    for value in "a b c".split():
+        output.write(value)
+    output.flush()
+    tmpdir.join('fail', 'b').mkdir().join('x').write('')
+    with pytest.raises(OutputError) as info:
+        output.close()
+    assert 'b:' in str(info.value)
+    assert tmpdir.join('fail', 'a').check(file=1) and tmpdir.join('fail', 'c').check(file=1)
+
+
+def test_stream():
+    from io import BytesIO, TextIOWrapper
+    from atmark.utils import get_stream
+
+    data = u"first\r\n\rsecond\n\nтретий\nlast".encode('utf-8')
+    for size in (1, 3, 1024):
+        stream = TextIOWrapper(BytesIO(data), encoding='utf-8')
+        lines = list(get_stream(stream, block_size=size))
+        assert lines == ['first', 'second', '', u'третий', 'last']
+
+    stream = TextIOWrapper(BytesIO(b"ok\nbad\xff\n"), encoding='utf-8')
+    gen = get_stream(stream)
+    assert next(gen) == 'ok'
+    with pytest.raises(UnicodeDecodeError):
+        next(gen)
+
+
+def test_slow_pipe():
+    import subprocess
+    import sys
+    import threading
+
+    # A line is printed as soon as it's written to the pipe, not at EOF
+    proc = subprocess.Popen(
+        [sys.executable, '-c', 'from atmark.atmark import at; at()', '--line-buffered', 'upper'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    timer = threading.Timer(10, proc.kill)
+    timer.start()
+    try:
+        for line in (b"a\n", b"b\n"):
+            proc.stdin.write(line)
+            proc.stdin.flush()
+            assert proc.stdout.readline() == line.upper()
+    finally:
+        timer.cancel()
+        proc.stdin.close()
+        proc.wait()
+    assert proc.returncode == 0
+
+
+def test_compile():
+    from atmark.pipeline import Arg, compile_tokens
+    from atmark.atmark import _tokenize
+
+    for chain in (
+            ['upper', 'replace', '-', '_', 'strip', '_', 'cap'],
+            ['split_', 'len'],
+            ['split', '-', 'head', 'upper', '# #2 @'],
+            ['grep', 'b', 'len', 'upper']):
+        tokens = list(_tokenize(list(chain)))
+        pipeline = compile_tokens(tokens)
+        for line in ('a-b-c', '_ab_', 'c d'):
+            expected = Arg(line).process(tokens)
+            arg = pipeline(line)
+            assert arg.value == expected.value
+            assert arg.history == expected.history
+
+    result = _at("test.py some-file", "upper", "sp", ".", "h", no_compile=True)
+    assert ["TEST", "SOME-FILE"] == result
+
+
+def test_history_refs():
+    from atmark.pipeline import Arg, compile_tokens, history_refs
+    from atmark.atmark import _tokenize
+
+    tokens = list(_tokenize(['upper', 'cap', 'len', '# #2 @']))
+    keep = history_refs(tokens)
+    assert keep == set([0, 2])
+
+    arg = Arg('ab', keep).process(tokens)
+    assert arg.history == {0: 'ab', 2: 'Ab'}
+    assert arg.value == 'ab Ab 2'
+
+    arg = compile_tokens(tokens, keep)('ab')
+    assert arg.history == {0: 'ab', 2: 'Ab'}
+    assert arg.value == 'ab Ab 2'
+
+    arg = compile_tokens(tokens)('ab')
+    assert len(arg.history) == 5
+
+
+def test_jobs():
+    from atmark import parallel
+
+    data = " ".join(str(num) for num in range(100))
+    result = _at(data, "grep", "1", "@!", jobs=2)
+    assert result == [str(num) + "!" for num in range(100) if "1" in str(num)]
+
+    result = _at(data, "grep", "1", "@!", jobs=2, unordered=True)
+    assert sorted(result) == sorted(str(num) + "!" for num in range(100) if "1" in str(num))
+
+    assert list(parallel.chunks(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+
+    # Errors of the unordered chunks are passed by the callback
+    parallel._initialize([], None, True)
+    assert parallel._attempt(['a']) == ['a']
+    parallel._process = None
+    assert isinstance(parallel._attempt(['a']), TypeError)
+
+
+def test_regexp():
+    from atmark.atmark import _tokenize
+    from atmark.utils import set_regexp_engine
+
+    [(_, params)] = _tokenize(['grep', r'\d+'])
+    assert params[0].search('a12')
+
+    result = _at("a1 b22 c", "kill", r"\d+")
+    assert result == ['a', 'b', 'c']
+
+    with pytest.raises(ValueError):
+        set_regexp_engine('unknown')
+
+
+def test_external_sort():
+    from atmark import streams
+
+    lines = [str(num % 97) * (num % 5) for num in range(1000)]
+    fan_in = streams.FAN_IN
+    try:
+        streams.set_memory('1K')
+        result = streams.Sorted(iter(lines))
+        assert list(result) == sorted(lines)
+
+        # Many runs are merged by a few at once
+        streams.FAN_IN = 3
+        streams.set_memory('200')
+        result = streams.Sorted(iter(lines + [u'\u0442\u0435\u043a\u0441\u0442']))
+        assert list(result) == sorted(lines + [u'\u0442\u0435\u043a\u0441\u0442'])
+    finally:
+        streams._memory[:] = []
+        streams.FAN_IN = fan_in
+
+    assert streams.set_memory('2M') == 2 * 1024 * 1024
+    streams._memory[:] = []
+
+    result = _atat("5 3 4 1 2", "sort", "take", "2")
+    assert result == ['1', '2']
+
+    result = _atat("5 3 4 1 2", "sort", "@!")
+    assert result == ['12345!']
+
+
+def test_lazy_stream():
+    from itertools import count
+    from atmark.atmark import _atat as atat
+
+    endless = (str(num) for num in count())
+    assert list(atat(['drop', '2', 'take', '3'], endless)) == ['2', '3', '4']
+    assert next(endless) == '5'
+
+    data = "c a  b d"
+    for chain in (['length'], ['last'], ['tail', 'head'], ['index', '2'],
+                  ['index', '-2'], ['index', '9'], ['filter'], ['drop', '-1'],
+                  ['sort', 'index', '1'], ['sort', 'last'], ['take', '-1']):
+        lines = data.split(' ')
+        lazy = list(atat(list(chain), iter(lines)))
+        assert lazy == list(atat(list(chain), iter(lines), debug=True))
+
+    assert list(atat(['filter'], iter([]))) == [None]
+
+
+def test_aggregate():
+    from atmark import sketches
+
+    data = "b a b c b a"
+    assert _atat(data, "uniq") == ['b', 'a', 'c']
+    for compiled in (True, False):
+        assert _at("hello", "uniq", "upper", no_compile=not compiled) == ['HELO']
+        assert _at("hello", "uniq", "split_", no_compile=not compiled) == ['helo']
+    assert _atat(data, "count") == ['3 b', '2 a', '1 c']
+    assert _atat(data, "topk", "2") == ['3 b', '2 a']
+    assert _atat(data, "distinct") == ['3']
+    assert _atat("1 x 2.5 10", "sum") == ['13.5']
+    assert _atat("1 x 2.5 10", "max") == ['10']
+    assert _atat("1 x 2.5 10", "min") == ['1']
+    assert _atat("x y", "min") == [None]
+
+    counter = sketches.HyperLogLog(0.01)
+    for num in range(10000):
+        counter.add(str(num))
+    assert abs(len(counter) - 10000) < 500
+
+    lines = [str(num) for num in range(100)] + ['hit'] * 50
+    assert sketches.CountMinSketch(0.01).most_common(lines, 1) == [('hit', 50)]
+
+
+def test_template():
+    from atmark.template import Template
+
+    template = Template("mv # @.jpg")
+    assert template.pieces == ['mv ', None, ' ', None, '.jpg']
+    assert template.numbers == set([0])
+
+    assert Template("@.bak").literals == ['', '.bak']
+    assert Template("#12").numbers == set([12])
+
+    result = _at("a#1 b", "upper", "@ #")
+    assert result == ['A#1 a#1', 'B b']
+
+    result = _at("a b", "\\@@ \\#\\\\")
+    assert result == ['@a #\\', '@b #\\']
+
+    # Unknown escapes reach the template without warnings, non-ASCII as is
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert _at(u"caf\u00e9", "\\@ \\t@ \\d") == [u'@ \tcaf\u00e9 \\d']
+
+
+def test_complete(tmpdir, monkeypatch):
+    from atmark._bashcomplete import completion_index, _index_path
+    from atmark.commands import commands_docs
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    index = completion_index()
+    assert index['upper'] == 0
+    assert index['replace'] == 2
+    assert tmpdir.join('atmark').check(dir=True)
+    assert completion_index() == index
+
+    with open(_index_path(), 'w') as f:
+        f.write("cached 1\n")
+    assert completion_index() == {'cached': 1}
+
+    assert 'upper' in commands_docs()
+
+
+def test_stats(tmpdir):
+    from atmark.stats import Stats
+    from atmark.utils import StringIO
+
+    stats = Stats()
+    result = _at("foo bar foo2", "grep", "^foo", "upper", stats=stats)
+    assert result == ['FOO', 'FOO2']
+    assert stats.lines == 3
+    grep, upper = stats.stages
+    assert grep.name == 'grep ^foo'
+    assert (grep.calls, grep.passed, grep.dropped) == (3, 2, 1)
+    assert (grep.bytes_in, grep.bytes_out) == (10, 7)
+    assert (upper.calls, upper.passed, upper.dropped) == (2, 2, 0)
+
+    stream = StringIO()
+    path = str(tmpdir.join('atmark.prom'))
+    stats.write(True, True, path, stream=stream)
+    report = stream.getvalue()
+    assert 'grep ^foo' in report
+    assert '"lines": 3' in report
+    with open(path) as f:
+        assert 'atmark_stage_dropped_total{stage="1",command="grep ^foo"} 1' in f.read()
+
+
+def test_field():
+    from atmark.atmark import _tokenize
+    from atmark.commands import at_field, at_field_, at_fields, at_join
+    from atmark.pipeline import history_refs, optimize
+
+    assert _at("a.b.c x", "field", ".", "1") == ['b']
+    assert _at("a.b.c x", "field", ".", "-1") == ['c', 'x']
+    assert _at("a.b.c", "fields", ".", "1-", "join", "+") == ['b+c']
+    assert _at("a.b.c", "fields", ".", "-1", "join", "+") == ['a+b']
+    assert _at("a:b:c", "fields", ":", "1-1") == ['b']
+
+    def optimized(*chain):
+        tokens = list(_tokenize(list(chain)))
+        return [func for func, _ in optimize(tokens, history_refs(tokens))]
+
+    assert optimized('split', '.', 'head') == [at_field]
+    assert optimized('split_', 'index', '2') == [at_field_]
+    assert optimized('split', '.', 'take', '2', 'join', '+') == [at_fields, at_join]
+    assert len(optimized('split', '.', 'head', '#2')) == 3
+
+    # The results are the same as of the full split
+    data = "a.b.c .b x. y"
+    for chain in (('head',), ('last',), ('index', '1'), ('index', '-2'), ('take', '2')):
+        result = _at(data, "split", ".", *chain)
+        assert result == _at(data, "split", ".", *chain, debug=True)
+        result = _at(data, "split_", *chain)
+        assert result == _at(data, "split_", *chain, debug=True)
+
+
+def test_optimize():
+    from atmark.atmark import _plan, _tokenize
+    from atmark.commands import at_format, at_grep, at_replace, at_strip, at_upper
+    from atmark.pipeline import history_refs, optimize
+
+    def optimized(*chain):
+        tokens = list(_tokenize(list(chain)))
+        return [func for func, _ in optimize(tokens, history_refs(tokens))]
+
+    assert optimized('upper', 'replace', '-', '_', 'grep', '1') == [at_grep, at_upper, at_replace]
+    assert optimized('upper', 'grep', 'a') == [at_upper, at_grep]
+    assert optimized('replace', '-', '_', 'grep', '_') == [at_replace, at_grep]
+    assert optimized('replace', '-', '_', 'grep', '^a') == [at_replace, at_grep]
+    assert optimized('upper', 'upper', 'rstrip', 'x', 'strip', 'x') == [at_upper, at_strip]
+    assert optimized('upper', 'replace', 'a', 'b', 'out') == [at_format]
+    assert optimized('upper', '#1', 'grep', '1') == [at_upper, at_format, at_grep]
+    assert optimized('upper', 'replace', '-', '_', '#1 @', 'grep', '1')[:2] == [at_upper, at_replace]
+    assert _plan(['replace', 'x', 'y', 'ng', 'a']) == [
+        'plan: notgrep a | replace x y', '  moved notgrep a before replace x y']
+
+    # The results are the same as of the commands as typed
+    data = "a-1 b-2 A_1 ab-12 a--1 \tx-y\t"
+    for chain in (
+            ('upper', 'grep', '1'), ('replace', '-', '_', 'grep', 'a_1'),
+            ('replace', '-', '', 'grep', 'a1'), ('replace', '-', '', 'grep', '1'),
+            ('replace', '-', '_', '==', 'b-2'), ('replace', '-', '_', '!=', 'b_2'),
+            ('replace', '-', '+', '==', 'a+1'), ('lower', 'ng', 'a'), ('strip', 'a', 'grep', 'b'),
+            ('strip_', 'grep', 'x-y'), ('rstrip', '1', 'strip', '1'), ('upper', 'ok', 'upper')):
+        assert _at(data, *chain) == _at(data, *chain, debug=True)
+
+
+def test_batch():
+    from atmark.atmark import _tokenize
+    from atmark.pipeline import compile_batch
+
+    data = "a-1 b-2 a-3 \033[31mc\033[0m"
+    for chain in (
+            ('upper',), ('grep', '^a', 'replace', '-', '+'), ('notgrep', 'b', '@.bak'),
+            ('==', 'b-2'), ('!=', 'b-2', 'kill', '\\d', 'filter', 'length'),
+            ('capitalize', 'strip', '1')):
+        assert _at(data, *chain, batch=2) == _at(data, *chain)
+
+    # Lists and the history are processed line by line
+    assert compile_batch(list(_tokenize(['split_', 'join', '-']))) is None
+    assert _at("a-1 b", "split", "-", "@ #", batch=2) == ['a1 a-1', 'b b']
+
+
+def test_compressed(tmpdir):
+    import bz2
+    import gzip
+    import io
+    from atmark.inputs import decompress, read_files
+    from atmark.utils import get_stream
+
+    data = "".join("line %d\n" % num for num in range(1000)).encode('utf-8')
+    paths = []
+    for name, module in (('a.gz', gzip), ('b.bz2', bz2)):
+        path = tmpdir.join(name)
+        path.write_binary(module.compress(data) + module.compress(b"last\n"))
+        paths.append(str(path))
+    plain = tmpdir.join('c.txt')
+    plain.write_binary(b"plain")
+    paths.append(str(plain))
+
+    # Blocks of a few bytes split the magic and the compressed members
+    compressed = gzip.compress(data)
+    blocks = [compressed[pos:pos + 3] for pos in range(0, len(compressed), 3)]
+    assert b"".join(decompress(blocks)) == data
+
+    lines = list(read_files(paths, block_size=100, concurrent=2))
+    assert len(lines) == 2003
+    assert lines[999:1002] == ['line 999', 'last', 'line 0']
+    assert lines[-1] == 'plain'
+
+    stream = io.TextIOWrapper(io.BytesIO(gzip.compress(b"a\nb\n")), encoding='utf-8')
+    assert list(get_stream(stream)) == ['a', 'b']
+
+    # Text which starts with a part of magic bytes is not decompressed
+    for text in (b"BZhello\n", b"BZh91AY\n", b"\x1f", b"BZ"):
+        stream = io.TextIOWrapper(io.BytesIO(text), encoding='latin-1')
+        assert list(get_stream(stream, block_size=1)) == [text.decode('latin-1').strip('\n')]
+    stream = io.TextIOWrapper(io.BytesIO(bz2.compress(b"")), encoding='utf-8')
+    assert list(get_stream(stream)) == []
+
+
+def test_memo():
+    from atmark.pipeline import Memo, is_pure, processor
+
+    calls = []
+
+    def at_count(arg):
+        calls.append(arg.value)
+        return arg.value.upper()
+
+    process = processor([(at_count, [])], memo=2)
+    assert isinstance(process, Memo)
+    assert [process(line).value for line in "a b a c a b".split()] == list("ABACAB")
+    assert calls == ['a', 'b', 'c', 'b']
+    assert (process.hits, process.misses) == (2, 4)
+
+    at_count.pure = False
+    assert not is_pure([(at_count, [])])
+    assert not isinstance(processor([(at_count, [])], memo=2), Memo)
+
+    assert _at("a b a", "upper", "@!", memo=10) == ['A!', 'B!', 'A!']
+
+
+def test_unique():
+    from atmark.sketches import Digests, ScalableBloomFilter
+    from atmark.streams import set_unique
+
+    data = "a-1 b-2 a-3 a-1 c-4 b-5"
+    try:
+        for mode in ('exact', 'hash', 'bloom', 'bloom:0.1'):
+            set_unique(mode)
+            assert _at(data, "unique_") == ['a-1', 'b-2', 'a-3', 'c-4', 'b-5']
+            assert _at(data, "field", "-", "0", "unique", "@", "#") == ['a-1', 'b-2', 'c-4']
+            assert _at(data, "field", "-", "0", "unique", "@", "#", jobs=2) == ['a-1', 'b-2', 'c-4']
+            assert _at(data, "unique_", memo=10) == ['a-1', 'b-2', 'a-3', 'c-4', 'b-5']
+    finally:
+        set_unique('exact')
+
+    with pytest.raises(ValueError):
+        set_unique('hash:0.1')
+
+    # The packed table of digests grows
+    digests = Digests(size=4)
+    for num in range(1000):
+        digests.add("key %d" % num)
+        digests.add("key %d" % num)
+    assert len(digests) == 1000 and len(digests.table) == 2048
+    assert all("key %d" % num in digests for num in range(1000))
+    assert sum("key %d" % num in digests for num in range(1000, 2000)) == 0
+
+    # The filter grows and keeps the rate of false positives
+    keys = ScalableBloomFilter(0.01, capacity=100)
+    for num in range(5000):
+        keys.add("key %d" % num)
+    assert len(keys.filters) > 1
+    assert 4900 < len(keys) <= 5000
+    assert sum("key %d" % num in keys for num in range(5000, 10000)) < 100
+
+
+def test_records(monkeypatch):
+    from atmark import records
+    from atmark.pipeline import Arg
+
+    monkeypatch.setattr(records, '_mode', [])
+    monkeypatch.setattr(records, '_header', dict())
+
+    line = '{"user":{"name":"bob"},"tags":["a","b"],"n":2,"ok":true}'
+    assert _at(line, "get", "user.name") == ['bob']
+    assert _at(line, "get", "tags.1") == ['b']
+    assert _at(line, "get", "tags") == ['["a","b"]']
+    assert _at(line, "get", "n", "@ #") == ['2 ' + line]
+    assert _at(line + ' broken', "get", "ok") == ['true']
+
+    # The line is parsed once and only when a field is requested
+    parsed = []
+    monkeypatch.setattr(records, '_loads', [lambda text: parsed.append(text) or dict(a=1)])
+    arg = Arg('{"a": 1}')
+    assert records.record(arg) == records.record(arg) == dict(a=1)
+    assert len(parsed) == 1
+    assert _at("x y", "grep", "z", "get", "a") == [] and len(parsed) == 1
+
+    assert _at('a,"b,c"', "col", "1") == ['b,c']
+    lines = records.csv_records(iter(['name,text', 'x,"a', 'b"', 'y,c']))
+    assert list(lines) == ['x,"a\nb"', 'y,c']
+    records.set_mode('csv')
+    assert _at('x,"a,b"', "get", "text") == ['a,b']
+
+
+def test_execute():
+    import os
+    from io import BytesIO
+    from atmark.execute import Executor, script
+
+    assert script(["echo a"]) == ['-c', "echo a"]
+
+    stdout, stderr = BytesIO(), BytesIO()
+    executor = Executor(jobs=3, size=2, stdout=stdout, stderr=stderr)
+    for command in _at("a b c d e", "echo @"):
+        executor.write(command)
+    executor.write("false")
+    executor.write("echo f")
+    executor.close()
+    assert stdout.getvalue() == b"a\nb\nc\nd\ne\nf\n"
+    assert (executor.scripts, executor.failed, executor.status) == (4, 1, 1)
+    assert b"1 of 4 scripts failed" in stderr.getvalue()
+
+    stdout = BytesIO()
+    executor = Executor(jobs=2, ordered=False, stdout=stdout, stderr=BytesIO())
+    for command in ("echo a", "echo b"):
+        executor.write(command)
+    executor.close()
+    assert sorted(stdout.getvalue().split()) == [b"a", b"b"]
+    assert executor.status == 0
+
+    # The commands of a shell don't affect each other
+    stdout = BytesIO()
+    executor = Executor(size=6, stdout=stdout, stderr=BytesIO())
+    for command in ("echo 1", "exit 0", "cd / && x=2", "pwd; echo $x", "if", "echo 3"):
+        executor.write(command)
+    executor.close()
+    assert stdout.getvalue() == ("1\n%s\n\n3\n" % os.getcwd()).encode('utf-8')
+    assert executor.status == 1
+
+    # An error of the unordered script is raised by the executor
+    executor = Executor(ordered=False, shell='/nonexistent/sh', stdout=BytesIO())
+    with pytest.raises(EnvironmentError):
+        executor.write("echo a")
+        executor.close()
+
+
+def test_follow(tmpdir):
+    import json
+    import os
+    import threading
+    import time
+    from atmark.atmark import _at
+    from atmark.follow import Poll, follow, watcher
+
+    path = str(tmpdir.join('app.log'))
+    checkpoint = str(tmpdir.join('app.offset'))
+
+    def append(name, data):
+        with open(name, 'ab') as stream:
+            stream.write(data)
+
+    append(path, b"a\nb\nc")
+    lines = follow(path, checkpoint, interval=0.05)
+    assert [next(lines), next(lines)] == ['a', 'b']
+
+    # The last line is taken when it's complete
+    append(path, b"c\nd\n")
+    assert next(lines) == 'cc'
+
+    # The offset of the processed lines is saved while waiting for the input
+    assert next(lines) == 'd'
+    result = []
+    thread = threading.Thread(target=lambda: result.append(next(lines)))
+    thread.start()
+    for _ in range(100):
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as stream:
+                if json.load(stream)['offset'] == 9:
+                    break
+        time.sleep(0.01)
+    append(path, b"e\n")
+    thread.join()
+    assert result == ['e']
+
+    # Rotation: the rest of the old file is read and the new one from the start
+    append(path, b"f\n")
+    os.rename(path, path + '.1')
+    append(path, b"g\n")
+    assert [next(lines), next(lines)] == ['f', 'g']
+
+    # Truncation
+    append(path, b"hh\n")
+    assert next(lines) == 'hh'
+    with open(path, 'wb') as stream:
+        stream.write(b"h\n")
+    assert next(lines) == 'h'
+
+    # The line in process is read again by the next run
+    lines.close()
+    lines = follow(path, checkpoint)
+    assert [str(arg) for arg in _at(['upper'], lines, max_count=1)] == ['H']
+    lines.close()
+
+    assert isinstance(watcher(str(tmpdir.join('missing', 'app.log'))), Poll)
+
+
+def test_follow_stop(tmpdir):
+    import json
+    from collections import OrderedDict
+    import os
+    import signal
+    import subprocess
+    import sys
+    import time
+
+    path = tmpdir.join('app.log')
+    path.write_binary("".join("line %d\n" % num for num in range(300000)).encode('ascii'))
+    size = path.size()
+    at = [sys.executable, '-c', 'from atmark.atmark import at; at()']
+
+    def offset(checkpoint):
+        try:
+            with open(checkpoint) as stream:
+                return json.load(stream)['offset']
+        except (EnvironmentError, ValueError):
+            return 0
+
+    for out_by in (None, str(tmpdir.join('parts', 'all.log'))):
+        checkpoint = str(tmpdir.join('app.offset'))
+        out = tmpdir.join('out.log')
+        for name in (checkpoint, str(out)):
+            if os.path.exists(name):
+                os.remove(name)
+        options = ['--follow', str(path), '--checkpoint', checkpoint] + (
+            ['--out-by', out_by] if out_by else [])
+
+        # SIGTERM stops following at any time, the results of the processed
+        # lines are written, the next run starts after them
+        for delay in (0.3, None):
+            with open(str(out), 'ab') as stdout:
+                proc = subprocess.Popen(at + options + ['upper'], stdout=stdout)
+                if delay:
+                    time.sleep(delay)
+                else:
+                    for _ in range(500):
+                        if offset(checkpoint) == size:
+                            break
+                        time.sleep(0.02)
+                proc.send_signal(signal.SIGTERM)
+                assert proc.wait() == 128 + signal.SIGTERM
+
+            # A line which processing is interrupted is taken again
+            results = (open(out_by) if out_by else out).read().split('\n')[:-1]
+            done = path.read_binary()[:offset(checkpoint)].count(b"\n")
+            assert list(OrderedDict.fromkeys(results))[:done] == [
+                "LINE %d" % num for num in range(done)]
+
+        assert done == 300000
+        assert 300000 <= len(results) <= 300001
+
+
+def test_max_count():
+    from atmark.atmark import _at, _atat
+
+    read = []
+
+    def lines(count):
+        for num in range(count):
+            read.append(num)
+            yield "line %d" % num
+
+    results = _at(['grep', '[02468]$'], lines(100), max_count=3)
+    assert [str(arg) for arg in results] == ['line 0', 'line 2', 'line 4']
+    assert len(read) == 5
+
+    del read[:]
+    assert list(_atat(['uniq'], lines(100), max_count=2)) == ['line 0', 'line 1']
+    assert len(read) == 2
+    assert list(_atat(['count'], lines(3), max_count=1)) == ['1 line 0']
+
+
+def test_broken_pipe():
+    import subprocess
+    import sys
+
+    # The input isn't read when the reader of the output is gone
+    proc = subprocess.Popen(
+        [sys.executable, '-c', 'from atmark.atmark import at; at()', 'grep', 'nomatch'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    proc.stdout.close()
+    try:
+        for _ in range(10000):
+            proc.stdin.write(b"line\n" * 1000)
+    except EnvironmentError:
+        pass
+    assert proc.wait() in (141, -13)
+    assert proc.stderr.read() == b""
+
+
+def test_server(tmpdir):
+    import os
+    import socket
+    import subprocess
+    import sys
+
+    env = dict(os.environ, ATMARK_SOCKET=str(tmpdir.join('atmark.sock')))
+    at = [sys.executable, '-c', 'from atmark.atmark import at; at()']
+
+    def run(*args):
+        proc = subprocess.Popen(
+            at + list(args), env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        out, err = proc.communicate(b"a-1\nb-2\n")
+        return proc.returncode, out, err
+
+    # Without a server the commands run in the process
+    assert run('replace', '-', '_') == (0, b"a_1\nb_2\n", b"")
+
+    server = subprocess.Popen(at + ['--server'], env=env, stderr=subprocess.PIPE)
+    try:
+        assert b"listening" in server.stderr.readline()
+        assert run('replace', '-', '_') == (0, b"a_1\nb_2\n", b"")
+        assert run('replace', '-', '_') == (0, b"a_1\nb_2\n", b"")
+        assert run('--exec', 'exit 3')[0] == 1
+        assert run('-j', 'abc', 'upper') == (
+            1, b"", b"atmark: -j abc: invalid literal for int() with base 10: 'abc'\n")
+
+        # Clients which are gone or send broken requests don't stop the server
+        for data in (b"", b"a\0\0\0", b"a\0\0\0\x03cwd"):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(env['ATMARK_SOCKET'])
+            client.sendall(data)
+            client.close()
+        assert run('replace', '-', '_') == (0, b"a_1\nb_2\n", b"")
+        assert server.poll() is None
+    finally:
+        server.terminate()
+        server.wait()
+    assert not tmpdir.join('atmark.sock').check()
+
+    # The client doesn't import the commands
+    modules = subprocess.check_output([sys.executable, '-c', (
+        'import sys; from atmark import client; '
+        'print(" ".join(sorted(m for m in sys.modules if m.startswith("atmark."))))')])
+    assert modules.split() == [b'atmark.client']
+
+    # A socket in a directory open to the others isn't used
+    from atmark.client import forward, is_trusted
+
+    shared = tmpdir.mkdir('shared')
+    path = str(shared.join('atmark.sock'))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        sock.listen(1)
+        shared.chmod(0o777)
+        assert not is_trusted(path)
+        os.environ['ATMARK_SOCKET'] = path
+        assert forward('at', ['upper']) is None
+        shared.chmod(0o700)
+        os.chmod(path, 0o600)
+        assert is_trusted(path)
+    finally:
+        os.environ.pop('ATMARK_SOCKET')
+        sock.close()
+
+
+def _at(data, *chain, **options):
     from atmark.atmark import _at as _, text_type, get_stream
     from atmark.utils import StringIO
     stream = StringIO("\n".join(data.split()))
     gen = get_stream(stream)
-    return list(map(text_type, _(list(map(text_type, chain)), stream=gen)))
+    return list(map(text_type, _(list(map(text_type, chain)), stream=gen, **options)))
 
 
 def _atat(data, *chain):
@@ -306,4 +1120,4 @@ def _atat(data, *chain):
     from atmark.utils import StringIO
     stream = StringIO("\n".join(data.split()))
     gen = get_stream(stream)
-    return _(list(map(text_type, chain)), stream=gen)
+    return list(_(list(map(text_type, chain)), stream=gen))